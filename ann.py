@@ -0,0 +1,195 @@
+# Purpose: Optional inverted-file (IVF) approximate nearest-neighbour index for large topics. The
+# chunks are grouped around k-means centroids at ingest time and a query only scans the `nprobe`
+# closest groups instead of every chunk.
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from retrieval import NPROBE, Retriever, normalize
+from store import STORE_DIR, load_store, store_paths
+
+# Topics with fewer chunks than this are searched exactly, the scan is already fast enough
+EXACT_SEARCH_THRESHOLD = 20000
+
+KMEANS_ITERATIONS = 20
+
+# Rows assigned to centroids at a time to bound the memory of the score matrix
+ASSIGN_BLOCK = 8192
+
+
+def index_path(topic):
+    return f"{STORE_DIR}{topic}_ivf.npz"
+
+
+def default_n_lists(n_rows):
+    return max(1, int(4 * np.sqrt(n_rows)))
+
+
+def assign(matrix, centroids):
+    """
+    Return the position of the most similar centroid for each row. The rows are unit-normalized a
+    block at a time, so a memory-mapped matrix is never loaded whole.
+    """
+    labels = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), ASSIGN_BLOCK):
+        block = normalize(matrix[start:start + ASSIGN_BLOCK])
+        labels[start:start + ASSIGN_BLOCK] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def kmeans(matrix, n_clusters, n_iter=KMEANS_ITERATIONS, seed=0):
+    """
+    Spherical k-means, trained on a unit-normalized sample of at most 256 rows per cluster
+    """
+    rng = np.random.default_rng(seed)
+    n_sample = min(len(matrix), 256 * n_clusters)
+    sample = normalize(matrix[np.sort(rng.choice(len(matrix), n_sample, replace=False))])
+    centroids = sample[rng.choice(n_sample, n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        labels = assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+
+        # Re-seed empty clusters with random sample rows
+        empty = np.bincount(labels, minlength=n_clusters) == 0
+        sums[empty] = sample[rng.choice(n_sample, int(empty.sum()))]
+        centroids = normalize(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Centroids plus, for each centroid, the sorted row positions of the chunks assigned to it.
+    The rows of list c are ids[offsets[c]:offsets[c + 1]].
+    """
+
+    def __init__(self, centroids, offsets, ids):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+
+    @classmethod
+    def build(cls, matrix, n_lists=None):
+        """
+        Train the centroids and fill the lists from a matrix of embeddings, memory-mapped or not
+        """
+        n_lists = min(len(matrix), n_lists or default_n_lists(len(matrix)))
+        centroids = kmeans(matrix, n_lists)
+        labels = assign(matrix, centroids)
+
+        # A stable sort keeps the ids of each list ascending, so scans read the matrix in order
+        ids = np.argsort(labels, kind='stable')
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(labels, minlength=n_lists))
+
+        return cls(centroids, offsets, ids)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['centroids'], data['offsets'], data['ids'])
+
+    def save(self, path):
+        # np.savez appends .npz unless the name already ends with it
+        tmp_path = path[:-len(".npz")] + ".tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, offsets=self.offsets, ids=self.ids)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def candidates(self, q_embedding, nprobe=NPROBE):
+        """
+        Row positions in the nprobe lists whose centroids are most similar to the query
+        """
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ q_embedding), nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([self.ids[self.offsets[c]:self.offsets[c + 1]] for c in probe]))
+
+
+def build_index(topic, n_lists=None):
+    """
+    Build and save the IVF index of a topic, or remove a stale one if the topic is small enough
+    to be searched exactly. Returns the index or None.
+    """
+    path = index_path(topic)
+    _, matrix = load_store(topic)
+    if len(matrix) < EXACT_SEARCH_THRESHOLD:
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+
+    index = IVFIndex.build(matrix, n_lists)
+    index.save(path)
+    print(f"Saved IVF index with {len(index.centroids)} lists to {path}")
+    return index
+
+
+def load_index(topic, n_rows):
+    """
+    Load the IVF index of a topic when there is one that matches the current embeddings
+    """
+    path = index_path(topic)
+    if n_rows < EXACT_SEARCH_THRESHOLD or not os.path.exists(path) or \
+            os.path.getmtime(path) < os.path.getmtime(store_paths(topic)[0]):
+        return None
+
+    index = IVFIndex.load(path)
+    if len(index) != n_rows:
+        return None
+
+    return index
+
+
+def recall_report(retriever, index, k=10, nprobes=(1, 2, 4, 8, 16, 32, 64), n_queries=200, seed=0):
+    """
+    Print recall@k and mean query latency of the index against exact search for each nprobe,
+    using chunks of the topic itself as queries
+    """
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(retriever.matrix[rng.choice(len(retriever), min(n_queries, len(retriever)),
+                                                     replace=False)])
+
+    exact = Retriever(retriever.texts, retriever.n_tokens, retriever.matrix)
+    start = time.perf_counter()
+    truth = [set(exact.search(q, k)[0]) for q in queries]
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+    print(f"exact       recall@{k} 1.000  {exact_ms:8.3f} ms/query")
+
+    for nprobe in nprobes:
+        approx = Retriever(retriever.texts, retriever.n_tokens, retriever.matrix, index=index, nprobe=nprobe)
+        start = time.perf_counter()
+        found = [set(approx.search(q, k)[0]) for q in queries]
+        approx_ms = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(t & f) / len(t) for t, f in zip(truth, found)])
+        print(f"nprobe={nprobe:<4} recall@{k} {recall:.3f}  {approx_ms:8.3f} ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an IVF index for a topic and report its recall")
+    parser.add_argument("topic")
+    parser.add_argument("--build", action="store_true", help="(re)build the index before reporting")
+    parser.add_argument("--lists", type=int, default=None, help="number of k-means lists")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nprobe", type=int, action="append", help="nprobe values to report, repeatable")
+    args = parser.parse_args()
+
+    meta, embeddings = load_store(args.topic)
+    if args.build:
+        # Build regardless of the topic size so small topics can be evaluated too
+        ivf = IVFIndex.build(embeddings, args.lists)
+        ivf.save(index_path(args.topic))
+    elif os.path.exists(index_path(args.topic)):
+        ivf = IVFIndex.load(index_path(args.topic))
+    else:
+        print(f"No index for {args.topic}, run with --build")
+        sys.exit(1)
+
+    recall_report(Retriever(meta['text'], meta['n_tokens'], embeddings), ivf, k=args.k,
+                  nprobes=args.nprobe or (1, 2, 4, 8, 16, 32, 64), n_queries=args.queries)
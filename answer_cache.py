@@ -0,0 +1,113 @@
+# Purpose: Caches for question answering: an in-memory LRU + TTL cache for question embeddings and
+# a persistent SQLite cache of chat responses
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_PATH = "processed/responses_cache.sqlite"
+
+
+def normalize_question(question):
+    """
+    Collapse whitespace so trivially different spellings of a question share cache entries
+    """
+    return " ".join(question.split())
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache holding at most max_size entries, each for at most ttl seconds
+    """
+
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), {len(self.entries)} entries"
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of chat responses holding at most max_entries, evicting the least recently used
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                          "last_used REAL NOT NULL)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(topic_version, model, question, context, **params):
+        """
+        Hash of everything the response depends on: the topic version, the model, the question,
+        the context and the sampling parameters
+        """
+        context_hash = hashlib.sha256(context.encode("UTF-8")).hexdigest()
+        payload = json.dumps([topic_version, model, normalize_question(question), context_hash, params],
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("UTF-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key, response):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, response, last_used) VALUES (?, ?, ?)",
+                              (key, response, time.time()))
+            self.conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                              "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self.conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)"
+
+    def close(self):
+        self.conn.close()
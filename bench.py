@@ -0,0 +1,259 @@
+# Purpose: Offline benchmarks of the ingest and retrieval stages against synthetic corpora and the
+# fake OpenAI backend: crawl throughput, chunking rate, embedding throughput, load_data time and
+# create_context latency percentiles at several store sizes
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from ann import build_index
+from bench_chunking import GO_WORDS
+from chunker import chunk_documents
+from crawler import crawl
+from csvdf import process_git_folder
+from embedder import embed_texts
+from fake_openai import EMBEDDING_DIM, FakeOpenAI
+from i import create_context, load_data
+from source_walker import scan
+from store import STORE_DIR, store_paths
+
+STAGES = ["crawl", "chunking", "embedding", "retrieval"]
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+# Rows of the synthetic embedding matrix generated at a time
+WRITE_BLOCK = 65536
+
+
+def report(name, value, unit):
+    print(f"{name:<44} {value:14,.1f} {unit}")
+
+
+def go_repo(folder, n_files, seed=0):
+    """
+    Write a Go-like repository of n_files files spread over packages, with a mix of short and long files
+    """
+    rng = random.Random(seed)
+    for i in range(n_files):
+        package = f"pkg{i % 50}"
+        os.makedirs(os.path.join(folder, package), exist_ok=True)
+        lines = [f"package {package}", ""]
+        for f in range(rng.choice([2, 10, 40, 150])):
+            lines.append(f"// Func{f} handles {' '.join(rng.choice(GO_WORDS) for _ in range(rng.randint(3, 12)))}.")
+            lines.append(f"func Func{f}(ctx context.Context) error {{")
+            for _ in range(rng.randint(2, 12)):
+                lines.append("\t" + " ".join(rng.choice(GO_WORDS) for _ in range(rng.randint(3, 10))))
+            lines.append("}")
+        with open(os.path.join(folder, package, f"file{i}.go"), "w", encoding="UTF-8") as out:
+            out.write("\n".join(lines) + "\n")
+
+
+def doc_page(i, n_pages, rng):
+    """
+    HTML page of a documentation site, with navigation, scripts and links to other pages
+    """
+    links = "".join(f'<li><a href="/docs/page{(i * 7 + k) % n_pages}">Page {(i * 7 + k) % n_pages}</a></li>'
+                    for k in range(1, 6))
+    paragraphs = "".join("<p>" + ". ".join(" ".join(rng.choice(GO_WORDS) for _ in range(rng.randint(5, 20)))
+                                           for _ in range(rng.randint(2, 8))) + ".</p>"
+                         for _ in range(rng.randint(3, 30)))
+    return (f"<html><head><title>Page {i}</title><script>window.analytics = {{}};</script>"
+            f"<style>body {{ margin: 0 }}</style></head><body><nav><ul>{links}</ul></nav>"
+            f"<main><h1>Page {i}</h1>{paragraphs}</main><footer>Docs footer</footer></body></html>")
+
+
+def serve_doc_site(n_pages, latency=0.0, seed=0):
+    """
+    Serve a synthetic documentation site of n_pages pages on localhost in a background thread.
+    Pages have an ETag and answer conditional requests with 304. Returns the server and its root URL.
+    """
+    rng = random.Random(seed)
+    pages = {f"/docs/page{i}": doc_page(i, n_pages, rng).encode("UTF-8") for i in range(n_pages)}
+    pages["/"] = b'<html><body><a href="/docs/page0">Docs</a></body></html>'
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency)
+            body = pages.get(self.path.rstrip("/") or "/")
+            if body is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            etag = f'"{hash(body) & 0xffffffff:x}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def synthetic_store(topic, n_chunks, dim=EMBEDDING_DIM, seed=0):
+    """
+    Write a topic store of n_chunks random unit-length embeddings with short texts, block by block so
+    the matrix never has to fit in memory
+    """
+    os.makedirs(STORE_DIR, exist_ok=True)
+    matrix_path, meta_path = store_paths(topic)
+    rng = np.random.default_rng(seed)
+    matrix = np.lib.format.open_memmap(matrix_path, mode="w+", dtype=np.float32, shape=(n_chunks, dim))
+    for start in range(0, n_chunks, WRITE_BLOCK):
+        block = rng.standard_normal((min(WRITE_BLOCK, n_chunks - start), dim), dtype=np.float32)
+        matrix[start:start + len(block)] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    matrix.flush()
+    del matrix
+
+    pd.DataFrame({
+        'text': [f"chunk {i} " + GO_WORDS[i % len(GO_WORDS)] for i in range(n_chunks)],
+        'n_tokens': rng.integers(20, 500, n_chunks),
+    }).to_parquet(meta_path, index=False)
+
+
+def bench_crawl(n_pages, latency):
+    server, url = serve_doc_site(n_pages, latency)
+    try:
+        for name in ("full crawl", "conditional recrawl"):
+            start = time.perf_counter()
+            # The crawler prints every URL it visits
+            with contextlib.redirect_stdout(io.StringIO()):
+                crawl(url, out_dir="text/")
+            elapsed = time.perf_counter() - start
+            report(f"crawl: {name} ({n_pages} pages)", (n_pages + 1) / elapsed, "pages/s")
+    finally:
+        server.shutdown()
+
+
+def bench_chunking(n_files):
+    go_repo("go-repo/", n_files)
+    start = time.perf_counter()
+    to_read, _, _ = scan("go-repo/", None)
+    documents = [text for _, text, _ in process_git_folder("go-repo/", to_read, {})]
+    read = time.perf_counter()
+    chunked = chunk_documents(documents)
+    done = time.perf_counter()
+
+    tokens = sum(n_tokens for n_tokens, _ in chunked)
+    chunks = sum(len(chunks) for _, chunks in chunked)
+    report(f"chunking: process_git_folder ({n_files} files)", n_files / (read - start), "files/s")
+    report(f"chunking: chunk_documents ({chunks} chunks)", tokens / (done - read), "tokens/s")
+
+
+def bench_embedding(n_chunks, latency, item_latency, requests_per_minute, tokens_per_minute):
+    texts = [f"chunk {i} " + " ".join(GO_WORDS[(i + j) % len(GO_WORDS)] for j in range(40)) for i in range(n_chunks)]
+    fake = FakeOpenAI(embed_latency=latency, embed_item_latency=item_latency,
+                      requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+    with fake, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        embed_texts(texts, requests_per_minute=requests_per_minute or 3000,
+                    tokens_per_minute=tokens_per_minute or 1000000)
+        elapsed = time.perf_counter() - start
+    report(f"embedding: embed_texts ({n_chunks} chunks)", n_chunks / elapsed, "chunks/s")
+    report(f"embedding: {fake.embed_requests} requests, rate limited", fake.rate_limited, "times")
+
+
+def bench_retrieval(sizes, dim, n_queries, build_ivf):
+    for n_chunks in sizes:
+        topic = f"bench{n_chunks}"
+        start = time.perf_counter()
+        synthetic_store(topic, n_chunks, dim)
+        if build_ivf:
+            with contextlib.redirect_stdout(io.StringIO()):
+                build_index(topic)
+        report(f"store: write {n_chunks} chunks", time.perf_counter() - start, "s")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            retriever = load_data(topic)
+            loaded = time.perf_counter() - start
+        report(f"load_data ({n_chunks} chunks)", loaded * 1000, "ms")
+
+        latencies = []
+        with FakeOpenAI(dim=dim):
+            for q in range(n_queries):
+                start = time.perf_counter()
+                create_context(f"benchmark question {q}", retriever)
+                latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies) * 1000
+        report(f"create_context p50 ({n_chunks} chunks)", np.percentile(latencies, 50), "ms")
+        report(f"create_context p99 ({n_chunks} chunks)", np.percentile(latencies, 99), "ms")
+
+        # The larger stores take gigabytes, drop each one once measured
+        del retriever
+        for path in store_paths(topic):
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest and retrieval offline with a fake OpenAI backend.")
+    parser.add_argument("stages", nargs="*", metavar="stage",
+                        help=f"stages to run among {', '.join(STAGES)} (default: all)")
+    parser.add_argument("--workdir", help="directory for the synthetic corpora and stores (default: a temporary one)")
+    parser.add_argument("--pages", type=int, default=500, help="pages of the synthetic doc site")
+    parser.add_argument("--page-latency", type=float, default=0.005, help="seconds the site takes per page")
+    parser.add_argument("--files", type=int, default=2000, help="files of the synthetic Go repository")
+    parser.add_argument("--chunks", type=int, default=20000, help="chunks embedded by the embedding benchmark")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per embedding request")
+    parser.add_argument("--embed-item-latency", type=float, default=0.0001, help="extra seconds per embedded text")
+    parser.add_argument("--rpm", type=int, help="requests per minute allowed by the fake backend")
+    parser.add_argument("--tpm", type=int, help="tokens per minute allowed by the fake backend")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma separated store sizes in chunks for load_data and create_context")
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIM, help="embedding dimension of the synthetic stores")
+    parser.add_argument("--queries", type=int, default=200, help="create_context calls per store size")
+    parser.add_argument("--ivf", action="store_true", help="build the IVF index for the synthetic stores")
+    args = parser.parse_args()
+    stages = args.stages or STAGES
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage}, choose among {', '.join(STAGES)}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ingest-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+
+    # Every stage works with paths relative to the working directory (processed/, text/, ...)
+    os.chdir(workdir)
+    try:
+        if "crawl" in stages:
+            bench_crawl(args.pages, args.page_latency)
+        if "chunking" in stages:
+            bench_chunking(args.files)
+        if "embedding" in stages:
+            bench_embedding(args.chunks, args.embed_latency, args.embed_item_latency, args.rpm, args.tpm)
+        if "retrieval" in stages:
+            bench_retrieval([int(size) for size in args.sizes.split(",")], args.dim, args.queries, args.ivf)
+    finally:
+        os.chdir(cwd)
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
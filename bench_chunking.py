@@ -0,0 +1,69 @@
+# Purpose: Benchmark tokens/sec of the single-pass chunker against the previous chunking path, which
+# tokenized each document, then each sentence, then each chunk again
+import random
+import sys
+import time
+
+from chunker import MAX_TOKENS, chunk_documents, get_tokenizer
+
+GO_WORDS = ["func", "return", "err", "nil", "if", "for", "range", "ctx", "uint64", "common.Hash", "struct",
+            "L2OutputOracle", "derivePayload", "batch", "block", "opts", "types.Transaction", ":=", "{", "}"]
+
+
+def synthetic_documents(n_docs, seed=0):
+    """
+    Go-like documents flattened the way process_git_folder does, with a mix of short and long files
+    """
+    rng = random.Random(seed)
+    documents = []
+    for i in range(n_docs):
+        n_sentences = rng.choice([3, 20, 80, 300])
+        sentences = (" ".join(rng.choice(GO_WORDS) for _ in range(rng.randint(3, 30))) for _ in range(n_sentences))
+        documents.append(f"file{i}.go. " + ". ".join(sentences))
+    return documents
+
+
+def legacy_chunk_documents(texts, max_tokens=MAX_TOKENS):
+    """
+    The chunking csvdf.py used to do, kept here as the baseline
+    """
+    tokenizer = get_tokenizer()
+    shortened = []
+    for text in texts:
+        if len(tokenizer.encode(text)) <= max_tokens:
+            shortened.append(text)
+            continue
+
+        sentences = text.split('. ')
+        n_tokens = [len(tokenizer.encode(" " + sentence)) for sentence in sentences]
+        tokens_so_far = 0
+        chunk = []
+        for sentence, token in zip(sentences, n_tokens):
+            if tokens_so_far + token > max_tokens:
+                shortened.append(". ".join(chunk) + ".")
+                chunk = []
+                tokens_so_far = 0
+            if token > max_tokens:
+                continue
+            chunk.append(sentence)
+            tokens_so_far += token + 1
+
+    return [(text, len(tokenizer.encode(text))) for text in shortened]
+
+
+def bench(name, fn, texts, total_tokens):
+    start = time.perf_counter()
+    fn(texts)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {elapsed:8.2f} s  {total_tokens / elapsed:12,.0f} tokens/sec")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    docs = synthetic_documents(n)
+    tokens = sum(len(get_tokenizer().encode(doc)) for doc in docs)
+    print(f"{n} documents, {tokens:,} tokens")
+
+    bench("before (3 encodes per doc)", legacy_chunk_documents, docs, tokens)
+    bench("after, single process", lambda texts: chunk_documents(texts, processes=1), docs, tokens)
+    bench("after, process pool", chunk_documents, docs, tokens)
@@ -0,0 +1,124 @@
+# Purpose: Benchmark the single-pass HTML extractor against the previous crawler path, which ran
+# BeautifulSoup's get_text() and a separate HTMLParser for the hyperlinks over each page, on saved
+# HTML fixtures (*.html files in a folder) or on synthetic documentation pages
+import argparse
+import glob
+import os
+import random
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+from bs4 import BeautifulSoup
+
+from html_extract import extract
+
+# Pages are parsed as if they had been fetched from this URL
+FIXTURE_URL = "https://docs.example.com/docs/page"
+
+
+class HyperlinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.hyperlinks = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "a" and "href" in attrs:
+            self.hyperlinks.append(attrs["href"])
+
+
+def get_domain_hyperlinks(local_domain, links, scheme="https"):
+    clean_links = []
+    for link in set(links):
+        clean_link = None
+        if re.search(r'^http[s]*://.+', link):
+            if urlparse(link).netloc == local_domain:
+                clean_link = link
+        else:
+            if link.startswith("/"):
+                link = link[1:]
+            elif link.startswith("#") or link.startswith("mailto:"):
+                continue
+            clean_link = scheme + "://" + local_domain + "/" + link
+
+        if clean_link is not None:
+            if clean_link.endswith("/"):
+                clean_link = clean_link[:-1]
+            clean_links.append(clean_link)
+    return list(set(clean_links))
+
+
+def legacy_extract(html, url):
+    """
+    What crawler.fetch_page used to do, kept here as the baseline
+    """
+    parser = HyperlinkParser()
+    parser.feed(html)
+    text = BeautifulSoup(html, "html.parser").get_text()
+    return text, get_domain_hyperlinks(urlparse(url).netloc, parser.hyperlinks, urlparse(url).scheme)
+
+
+def extract_fixture(html):
+    return extract(html, FIXTURE_URL)
+
+
+def read_fixtures(folder):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(folder, "*.html"))):
+        with open(path, "r", encoding="UTF-8", errors="replace") as f:
+            pages.append(f.read())
+    return pages
+
+
+def write_fixtures(folder, n_pages, repeat=5, seed=0):
+    """
+    Save synthetic documentation pages (see bench.doc_page), each repeated to the size of a long doc page
+    """
+    from bench import doc_page
+
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    for i in range(n_pages):
+        with open(os.path.join(folder, f"page{i:05d}.html"), "w", encoding="UTF-8") as f:
+            f.write(doc_page(i, n_pages, rng) * repeat)
+
+
+def bench(name, fn, pages):
+    size = sum(len(page.encode("UTF-8")) for page in pages)
+    start = time.perf_counter()
+    fn(pages)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<32} {elapsed:8.2f} s  {len(pages) / elapsed:10,.0f} pages/sec  "
+          f"{size / elapsed / 2 ** 20:8.1f} MiB/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare HTML extraction paths on saved pages")
+    parser.add_argument("fixtures", nargs="?", help="folder of *.html files, synthetic pages when omitted")
+    parser.add_argument("--pages", type=int, default=500, help="synthetic pages to generate")
+    parser.add_argument("--write-fixtures", metavar="FOLDER", help="save the synthetic pages to FOLDER and exit")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.write_fixtures:
+        write_fixtures(args.write_fixtures, args.pages)
+        raise SystemExit(0)
+
+    if args.fixtures:
+        html_pages = read_fixtures(args.fixtures)
+    else:
+        from bench import doc_page
+
+        fixture_rng = random.Random(0)
+        html_pages = [doc_page(i, args.pages, fixture_rng) * 5 for i in range(args.pages)]
+    print(f"{len(html_pages)} pages, {sum(map(len, html_pages)) / 2 ** 20:.1f} MiB")
+
+    bench("before (BeautifulSoup + links)", lambda pages: [legacy_extract(page, FIXTURE_URL) for page in pages],
+          html_pages)
+    bench("after, single process", lambda pages: [extract_fixture(page) for page in pages], html_pages)
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        bench("after, process pool", lambda pages: list(pool.map(extract_fixture, pages, chunksize=16)),
+              html_pages)
@@ -0,0 +1,70 @@
+# Purpose: Guard the start-up time of the CLIs. Measures how long importing qa.py and i.py and
+# running `qa.py --help` / `qa.py --list` take in fresh interpreters, checks that none of the heavy
+# modules gets imported on those paths and exits with status 1 on a regression.
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Wall time allowed for a command that does not load a topic
+STARTUP_BUDGET = 1.0
+
+# Modules that must only be imported once a command needs them
+HEAVY_MODULES = ["numpy", "pandas", "pyarrow", "openai", "tiktoken", "scipy", "sklearn", "plotly", "matplotlib",
+                 "requests", "aiohttp"]
+
+RUNS = 5
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_time(args, runs=RUNS):
+    """
+    Median wall time of a command run in a fresh interpreter from the repository directory
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=REPO_DIR, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def heavy_imports(module):
+    """
+    Heavy modules loaded by importing a module
+    """
+    code = f"import json, sys; import {module}; print(json.dumps(sorted(sys.modules)))"
+    output = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, check=True, capture_output=True,
+                            text=True).stdout
+    loaded = set(json.loads(output.splitlines()[-1]))
+    return [name for name in HEAVY_MODULES if name in loaded]
+
+
+def main():
+    failures = []
+
+    for module in ("qa", "i"):
+        seconds = run_time(["-c", f"import {module}"])
+        heavy = heavy_imports(module)
+        print(f"import {module:<22} {seconds * 1000:8.1f} ms  heavy modules: {', '.join(heavy) or 'none'}")
+        if heavy:
+            failures.append(f"import {module} loads {', '.join(heavy)}")
+        if seconds > STARTUP_BUDGET:
+            failures.append(f"import {module} took {seconds:.2f}s")
+
+    for args in (["qa.py", "--help"], ["qa.py", "--list"]):
+        seconds = run_time(args)
+        print(f"{' '.join(args):<29} {seconds * 1000:8.1f} ms")
+        if seconds > STARTUP_BUDGET:
+            failures.append(f"{' '.join(args)} took {seconds:.2f}s, over the {STARTUP_BUDGET}s budget")
+
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+# Purpose: Split documents into chunks of at most MAX_TOKENS tokens at sentence boundaries,
+# tokenizing each document only once
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+
+import tiktoken
+
+MAX_TOKENS = 500
+
+# Corpora with at least this many documents are chunked across a process pool
+PARALLEL_THRESHOLD = 256
+
+_tokenizer = None
+
+
+def get_tokenizer():
+    """
+    Load the cl100k_base tokenizer, which is designed to work with the ada-002 model, once per process
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = tiktoken.get_encoding("cl100k_base")
+    return _tokenizer
+
+
+def chunk_document(text, max_tokens=MAX_TOKENS):
+    """
+    Return the number of tokens of the document and its list of (chunk, n_tokens). Documents within
+    max_tokens are a single chunk. Longer ones are split into sentences, and sentences are packed
+    into chunks without going over max_tokens; a sentence longer than max_tokens is dropped.
+    """
+    if not isinstance(text, str):
+        return 0, []
+
+    tokenizer = get_tokenizer()
+    tokens = tokenizer.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return len(tokens), [(text, len(tokens))]
+
+    # Byte offset where each token starts in the UTF-8 encoded document
+    token_starts = list(accumulate((len(b) for b in tokenizer.decode_tokens_bytes(tokens)), initial=0))[:-1]
+
+    # Split the text into sentences and find the byte offset where each one starts. Like the
+    # " " + sentence that used to be encoded, a sentence starts at the space of the ". " before it.
+    sentences = text.split('. ')
+    sentence_ends = list(accumulate(len(s.encode("UTF-8")) + 2 for s in sentences))
+    sentence_starts = [0] + [end - 1 for end in sentence_ends[:-1]] + [sentence_ends[-1] - 2]
+
+    # A sentence gets the tokens that start inside it
+    token_bounds = [bisect_left(token_starts, start) for start in sentence_starts]
+    n_tokens = [end - start for start, end in zip(token_bounds, token_bounds[1:])]
+
+    chunks = []
+    tokens_so_far = 0
+    chunk = []
+
+    # Loop through the sentences and tokens joined together in a tuple
+    for sentence, token in zip(sentences, n_tokens):
+
+        # If the number of tokens so far plus the number of tokens in the current sentence is greater
+        # than the max number of tokens, then add the chunk to the list of chunks and reset
+        # the chunk and tokens so far
+        if tokens_so_far + token > max_tokens and chunk:
+            chunks.append((". ".join(chunk) + ".", tokens_so_far))
+            chunk = []
+            tokens_so_far = 0
+
+        # If the number of tokens in the current sentence is greater than the max number of
+        # tokens, go to the next sentence
+        if token > max_tokens:
+            continue
+
+        # Otherwise, add the sentence to the chunk and add the number of tokens to the total
+        chunk.append(sentence)
+        tokens_so_far += token
+
+    # Keep the last chunk
+    if chunk:
+        chunks.append((". ".join(chunk) + ".", tokens_so_far))
+
+    return len(tokens), chunks
+
+
+def _chunk_document(args):
+    return chunk_document(*args)
+
+
+def chunk_documents(texts, max_tokens=MAX_TOKENS, processes=None):
+    """
+    Chunk every document, across a process pool for large corpora. Returns one
+    (n_tokens, chunks) per document in order.
+    """
+    texts = list(texts)
+    if len(texts) < PARALLEL_THRESHOLD or processes == 1:
+        return [chunk_document(text, max_tokens) for text in texts]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_chunk_document, ((text, max_tokens) for text in texts), chunksize=64))
@@ -0,0 +1,178 @@
+# Purpose: Persisted crawl state per domain: the validators and content hash of every page for
+# conditional re-crawls, and the frontier of the current crawl so it can resume after a crash.
+# The frontier lives on disk so its size does not bound the crawl, see frontier.py for how it is filled.
+import json
+import os
+import sqlite3
+
+STATE_DIR = "processed/crawl/"
+
+# States of a frontier URL
+QUEUED = 0
+DONE = 1
+IN_FLIGHT = 2
+
+# Host parameters per statement SQLite accepts in every version
+MAX_SQL_VARIABLES = 999
+
+
+class CrawlState:
+    """
+    SQLite-backed state of the crawls of one domain. Each full crawl gets a new crawl id; pages
+    record the last crawl that saw them and the last crawl in which their content changed.
+    """
+
+    def __init__(self, local_domain, state_dir=STATE_DIR):
+        os.makedirs(state_dir, exist_ok=True)
+        self.local_domain = local_domain
+        self.manifest_path = f"{state_dir}{local_domain}_changed.json"
+        self.conn = sqlite3.connect(f"{state_dir}{local_domain}.sqlite")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY, path TEXT NOT NULL, etag TEXT, last_modified TEXT, hash TEXT,
+                links TEXT NOT NULL DEFAULT '', seen_in INTEGER NOT NULL, changed_in INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS frontier (url TEXT PRIMARY KEY, done INTEGER NOT NULL DEFAULT 0);
+        """)
+        # Frontiers of older versions only had the URL and whether it was done
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(frontier)")}
+        if "depth" not in columns:
+            self.conn.execute("ALTER TABLE frontier ADD COLUMN depth INTEGER NOT NULL DEFAULT 0")
+        if "rank" not in columns:
+            self.conn.execute("ALTER TABLE frontier ADD COLUMN rank REAL NOT NULL DEFAULT 0")
+        # URLs are handed out by rank, then in the order they were queued
+        self.conn.execute("CREATE INDEX IF NOT EXISTS frontier_next ON frontier (done, rank)")
+        self.conn.commit()
+        self.crawl_id = self._get_meta("crawl_id", 0)
+
+    def _get_meta(self, key, default):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def start(self, url):
+        """
+        Resume the unfinished crawl if there is one and return True, otherwise start a new crawl from
+        url and return False. URLs that were in flight when the last run stopped are queued again.
+        """
+        with self.conn:
+            self.conn.execute("UPDATE frontier SET done = ? WHERE done = ?", (QUEUED, IN_FLIGHT))
+        pending = self.frontier_pending()
+        if pending:
+            print(f"Resuming crawl of {self.local_domain} with {pending} queued URLs")
+            return True
+
+        with self.conn:
+            self.crawl_id += 1
+            self._set_meta("crawl_id", self.crawl_id)
+            self.conn.execute("DELETE FROM frontier")
+            self.conn.execute("INSERT INTO frontier (url) VALUES (?)", (url,))
+        return False
+
+    def page(self, url):
+        """
+        Return the stored (etag, last_modified, hash, links) of a page, or None if it was never fetched
+        """
+        row = self.conn.execute("SELECT etag, last_modified, hash, links FROM pages WHERE url = ?",
+                                (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, content_hash, links = row
+        return etag, last_modified, content_hash, links.split("\n") if links else []
+
+    def record(self, url, path, etag, last_modified, content_hash, links, changed):
+        """
+        Record a fetched page and mark it done in the frontier
+        """
+        changed_in = self.crawl_id if changed else \
+            self.conn.execute("SELECT changed_in FROM pages WHERE url = ?", (url,)).fetchone()[0]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO pages (url, path, etag, last_modified, hash, links, seen_in, changed_in) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (url, path, etag, last_modified, content_hash, "\n".join(links), self.crawl_id, changed_in))
+        self.conn.execute("UPDATE frontier SET done = ? WHERE url = ?", (DONE, url))
+
+    def skip(self, url, keep=True):
+        """
+        Mark a page that could not be fetched done. With keep its previous version, if there is one,
+        is kept, otherwise finish() removes it.
+        """
+        # Crawl ids start at 1, seen_in 0 marks a page as gone
+        self.conn.execute("UPDATE pages SET seen_in = ? WHERE url = ?", (self.crawl_id if keep else 0, url))
+        self.conn.execute("UPDATE frontier SET done = ? WHERE url = ?", (DONE, url))
+
+    def enqueue(self, entries):
+        """
+        Queue (url, depth, rank) entries, URLs already in the frontier are left as they are
+        """
+        self.conn.executemany("INSERT OR IGNORE INTO frontier (url, depth, rank) VALUES (?, ?, ?)", entries)
+
+    def queued(self, urls):
+        """
+        The URLs among urls that are already in the frontier of this crawl
+        """
+        found = set()
+        for i in range(0, len(urls), MAX_SQL_VARIABLES):
+            batch = urls[i:i + MAX_SQL_VARIABLES]
+            found.update(row[0] for row in self.conn.execute(
+                f"SELECT url FROM frontier WHERE url IN ({','.join('?' * len(batch))})", batch))
+        return found
+
+    def lease(self, n):
+        """
+        Mark the next n queued URLs, lowest rank first, as in flight and return them with their depth
+        """
+        rows = self.conn.execute("SELECT url, depth FROM frontier WHERE done = ? ORDER BY rank, rowid LIMIT ?",
+                                 (QUEUED, n)).fetchall()
+        self.conn.executemany("UPDATE frontier SET done = ? WHERE url = ?", [(IN_FLIGHT, url) for url, _ in rows])
+        return rows
+
+    def frontier_urls(self):
+        """
+        Iterate over every URL queued in this crawl, done or not
+        """
+        return (row[0] for row in self.conn.execute("SELECT url FROM frontier"))
+
+    def frontier_pending(self):
+        return self.conn.execute("SELECT COUNT(*) FROM frontier WHERE done = ?", (QUEUED,)).fetchone()[0]
+
+    def frontier_done(self):
+        return self.conn.execute("SELECT COUNT(*) FROM frontier WHERE done != ?", (QUEUED,)).fetchone()[0]
+
+    def commit(self):
+        self.conn.commit()
+
+    def finish(self, complete=True):
+        """
+        Close the current crawl: pages it did not reach are dropped and their text files removed.
+        A crawl that is not complete, cut short by a page budget, only drops the pages found gone.
+        Writes the manifest of changed and removed files for the ingest step and returns it.
+        """
+        if complete:
+            dropped, params = "seen_in < ?", (self.crawl_id,)
+        else:
+            dropped, params = "seen_in = 0", ()
+        changed = [row[0] for row in self.conn.execute(
+            "SELECT path FROM pages WHERE changed_in = ? AND seen_in = ?", (self.crawl_id, self.crawl_id))]
+        removed = [row[0] for row in self.conn.execute(
+            f"SELECT path FROM pages WHERE {dropped}", params)]
+
+        for path in removed:
+            if os.path.exists(path):
+                os.remove(path)
+
+        with self.conn:
+            self.conn.execute(f"DELETE FROM pages WHERE {dropped}", params)
+            self.conn.execute("DELETE FROM frontier")
+
+        manifest = {"crawl_id": self.crawl_id, "changed": changed, "removed": removed}
+        with open(self.manifest_path, "w", encoding="UTF-8") as f:
+            json.dump(manifest, f, indent=2)
+
+        return manifest
+
+    def close(self):
+        self.conn.close()
@@ -1,139 +1,257 @@
+import argparse
+import hashlib
 import os
-import re
-import urllib.request
-from collections import deque
-from html.parser import HTMLParser
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from urllib.parse import urlparse
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
-# Regex pattern to match a URL
-HTTP_URL_PATTERN = r'^http[s]*://.+'
+import instrument
+from crawl_state import CrawlState
+from frontier import BFS, ORDERS, Frontier, canonical_url, sitemap_urls
+from html_extract import extract
 
 domain = "stack.optimism.io"  # <- put your domain to be crawled
 full_url = "https://stack.optimism.io"  # <- put your domain to be crawled with https or http
 
-
-# Create a class to parse the HTML and get the hyperlinks
-class HyperlinkParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        # Create a list to store the hyperlinks
-        self.hyperlinks = []
-
-    # Override the HTMLParser's handle_starttag method to get the hyperlinks
-    def handle_starttag(self, tag, attrs):
-        attrs = dict(attrs)
-
-        # If the tag is an anchor tag, and it has a href attribute, add the href attribute to the list of hyperlinks
-        if tag == "a" and "href" in attrs:
-            self.hyperlinks.append(attrs["href"])
-
-
-# Function to get the hyperlinks from a URL
-def get_hyperlinks(url):
-    # Try to open the URL and read the HTML
-    try:
-        # Open the URL and read the HTML
-        with urllib.request.urlopen(url) as response:
-
-            # If the response is not HTML, return an empty list
-            if not response.info().get('Content-Type').startswith("text/html"):
-                return []
-
-            # Decode the HTML
-            html = response.read().decode('utf-8')
-    except Exception as e:
-        print(e)
-        return []
-
-    # Create the HTML Parser and then Parse the HTML to get hyperlinks
-    parser = HyperlinkParser()
-    parser.feed(html)
-
-    return parser.hyperlinks
-
-
-# Function to get the hyperlinks from a URL that are within the same domain
-def get_domain_hyperlinks(local_domain, url):
-    clean_links = []
-    for link in set(get_hyperlinks(url)):
-        clean_link = None
-
-        # If the link is a URL, check if it is within the same domain
-        if re.search(HTTP_URL_PATTERN, link):
-            # Parse the URL and check if the domain is the same
-            url_obj = urlparse(link)
-            if url_obj.netloc == local_domain:
-                clean_link = link
-
-        # If the link is not a URL, check if it is a relative link
-        else:
-            if link.startswith("/"):
-                link = link[1:]
-            elif link.startswith("#") or link.startswith("mailto:"):
-                continue
-            clean_link = "https://" + local_domain + "/" + link
-
-        if clean_link is not None:
-            if clean_link.endswith("/"):
-                clean_link = clean_link[:-1]
-            clean_links.append(clean_link)
-
-    # Return the list of hyperlinks that are within the same domain
-    return list(set(clean_links))
-
-
-def crawl(url):
+# Number of pages fetched at the same time, overall and per host
+MAX_WORKERS = 16
+MAX_PER_HOST = 4
+
+# Pages waiting to be written to disk before fetching blocks
+WRITE_QUEUE_SIZE = 64
+
+REQUEST_TIMEOUT = 30
+
+# Processes extracting text and links from the fetched pages, 1 extracts in the fetch threads
+PARSE_PROCESSES = None
+
+# Links followed from the start page and pages fetched at most per crawl, None for no limit
+MAX_DEPTH = None
+MAX_PAGES = None
+
+
+def new_session(max_workers=MAX_WORKERS):
+    """
+    Session shared by all fetch threads so connections are kept alive and reused
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HostLimiter:
+    """
+    Caps the number of requests in flight to each host
+    """
+
+    def __init__(self, per_host=MAX_PER_HOST):
+        self.per_host = per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+
+def fetch_page(session, limiter, url, known=None, parser=None):
+    """
+    Download a page once and return its text, the links to other pages of the site it contains and
+    its ETag and Last-Modified validators. With the validators of an earlier crawl in `known` the
+    request is conditional and None is returned when the server answers 304 Not Modified.
+    HTML is parsed in the parser process pool when there is one.
+    """
+    headers = {}
+    if known is not None:
+        etag, last_modified = known[0], known[1]
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    with limiter(urlparse(url).netloc):
+        started = time.perf_counter()
+        response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        instrument.observe("crawl.fetch_ms", (time.perf_counter() - started) * 1000)
+    instrument.count("crawl.bytes_received", len(response.content))
+
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+
+    # If the response is not HTML, there are no tags to remove nor hyperlinks to follow
+    text = response.text
+    links = []
+    if response.headers.get('Content-Type', '').startswith("text/html"):
+        started = time.perf_counter()
+        text, links = parser.submit(extract, text, url).result() if parser is not None else extract(text, url)
+        instrument.observe("crawl.parse_ms", (time.perf_counter() - started) * 1000)
+
+    return text, links, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+
+def page_path(local_domain, url, out_dir="text/"):
+    return out_dir + local_domain + '/' + url.split("://", 1)[-1].replace("/", "_") + ".txt"
+
+
+def write_pages(pages):
+    """
+    Write (path, text) pairs from the queue until a None arrives
+    """
+    while True:
+        item = pages.get()
+        if item is None:
+            return
+        path, text = item
+        try:
+            with open(path, "w", encoding="UTF-8") as f:
+                f.write(text)
+        except OSError as e:
+            print(e)
+
+
+def crawl(url, out_dir="text/", max_workers=MAX_WORKERS, per_host=MAX_PER_HOST, parse_processes=PARSE_PROCESSES,
+          max_depth=MAX_DEPTH, max_pages=MAX_PAGES, order=BFS, sitemap=True, follow_links=True):
+    """
+    Crawl the site of url breadth first, or with order="sitemap" the pages its sitemaps list first,
+    within max_depth links of url and max_pages pages. With sitemap the pages listed in the site's
+    sitemaps are queued up front, and without follow_links only those and url itself are fetched.
+    """
+    url = canonical_url(url) or url
     # Parse the URL and get the domain
     local_domain = urlparse(url).netloc
 
-    # Create a queue to store the URLs to crawl
-    queue = deque([url])
-
-    # Create a set to store the URLs that have already been seen (no duplicates)
-    seen = {url}
-
     # Create a directory to store the text files
-    if not os.path.exists("text/"):
-        os.mkdir("text/")
-
-    if not os.path.exists("text/" + local_domain + "/"):
-        os.mkdir("text/" + local_domain + "/")
+    os.makedirs(out_dir + local_domain + "/", exist_ok=True)
 
     # Create a directory to store the csv files
-    if not os.path.exists("processed"):
-        os.mkdir("processed")
-
-    # While the queue is not empty, continue crawling
-    while queue:
-
-        # Get the next URL from the queue
-        url = queue.pop()
-        print(url)  # for debugging and to see the progress
-
-        # Save text from the url to a <url>.txt file
-        with open('text/' + local_domain + '/' + url[8:].replace("/", "_") + ".txt", "w", encoding="UTF-8") as f:
-
-            # Get the text from the URL using BeautifulSoup
-            soup = BeautifulSoup(requests.get(url).text, "html.parser")
-
-            # Get the text but remove the tags
-            text = soup.get_text()
-
-            # If the crawler gets to a page that requires JavaScript, it will stop the crawl
-            if "You need to enable JavaScript to run this app." in text:
-                print("Unable to parse page " + url + " due to JavaScript being required")
-
-            # Otherwise, write the text to the file in the text directory
-            f.write(text)
-
-        # Get the hyperlinks from the URL and add them to the queue
-        for link in get_domain_hyperlinks(local_domain, url):
-            if link not in seen:
-                queue.append(link)
-                seen.add(link)
-
-
-crawl(full_url)
+    os.makedirs("processed", exist_ok=True)
+
+    # The frontier and the page validators are persisted, so an interrupted crawl resumes where it
+    # stopped and pages that did not change since the last crawl are neither rewritten nor re-processed
+    state = CrawlState(local_domain)
+    frontier = Frontier(state, local_domain, max_depth=max_depth, max_pages=max_pages, order=order)
+
+    session = new_session(max_workers)
+    limiter = HostLimiter(per_host)
+
+    if not frontier.start(url) and sitemap:
+        queued = frontier.add_sitemap(sitemap_urls(session, url, timeout=REQUEST_TIMEOUT))
+        state.commit()
+        print(f"Queued {queued} pages from the sitemaps of {local_domain}")
+
+    # Pages are written by a single thread through a bounded queue so slow disks apply back pressure
+    pages = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    writer = threading.Thread(target=write_pages, args=(pages,), daemon=True)
+    writer.start()
+
+    # Parsing is CPU bound, in a process pool it no longer holds the GIL the fetch threads need
+    parser = ProcessPoolExecutor(max_workers=parse_processes) if parse_processes != 1 else None
+
+    # Time spent fetching, parsing and recording pages, see instrument.py for the run report
+    with instrument.stage("crawl"), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+
+        # While there are URLs to crawl or pages being fetched, continue crawling
+        while True:
+            for next_url, depth in frontier.next(max_workers - len(in_flight)):
+                print(next_url)  # for debugging and to see the progress
+                known = state.page(next_url)
+
+                # Fetch unconditionally when the text file of a known page went missing
+                if known is not None and not os.path.exists(page_path(local_domain, next_url, out_dir)):
+                    known = (None, None) + known[2:]
+
+                in_flight[executor.submit(fetch_page, session, limiter, next_url, known, parser)] = \
+                    next_url, known, depth
+
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                page_url, known, depth = in_flight.pop(future)
+                path = page_path(local_domain, page_url, out_dir)
+                try:
+                    result = future.result()
+                except requests.HTTPError as e:
+                    print(e)
+                    instrument.count("crawl.errors")
+                    # Pages that are gone are dropped, other errors keep the last crawled version
+                    state.skip(page_url, keep=e.response.status_code not in (404, 410))
+                    continue
+                except Exception as e:
+                    print(e)
+                    instrument.count("crawl.errors")
+                    state.skip(page_url)
+                    continue
+
+                if result is None:
+                    # 304 Not Modified, reuse what the last crawl stored
+                    etag, last_modified, content_hash, links = known
+                    changed = False
+                    instrument.count("crawl.not_modified")
+                else:
+                    text, links, etag, last_modified = result
+
+                    # If the crawler gets to a page that requires JavaScript, it will stop the crawl
+                    if "You need to enable JavaScript to run this app." in text:
+                        print("Unable to parse page " + page_url + " due to JavaScript being required")
+
+                    content_hash = hashlib.sha256(text.encode("UTF-8")).hexdigest()
+                    changed = known is None or known[2] != content_hash or not os.path.exists(path)
+
+                    # Save text from the url to a <url>.txt file when it changed
+                    if changed:
+                        pages.put((path, text))
+                        instrument.count("crawl.pages_changed")
+
+                state.record(page_url, path, etag, last_modified, content_hash, links, changed)
+                instrument.count("crawl.pages_fetched")
+
+                # Add the hyperlinks from the page to the queue
+                if follow_links:
+                    frontier.add(links, depth + 1)
+
+            state.commit()
+
+    pages.put(None)
+    writer.join()
+    session.close()
+    if parser is not None:
+        parser.shutdown()
+
+    manifest = state.finish(complete=not frontier.truncated)
+    state.close()
+    print(f"Crawled {local_domain}: {len(manifest['changed'])} changed and {len(manifest['removed'])} removed "
+          f"pages, see {state.manifest_path}")
+    if frontier.truncated:
+        print(f"Stopped at the budget of {max_pages} pages, pages not reached are kept from earlier crawls")
+
+    instrument.gauge("crawl.pages_per_second", instrument.rate("crawl.pages_fetched", "crawl"))
+    instrument.write_report()
+
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl a site into text files")
+    parser.add_argument("url", nargs="?", default=full_url)
+    parser.add_argument("--max-depth", type=int, default=MAX_DEPTH, help="links followed from the start page")
+    parser.add_argument("--max-pages", type=int, default=MAX_PAGES, help="pages fetched at most")
+    parser.add_argument("--order", choices=ORDERS, default=BFS)
+    parser.add_argument("--no-sitemap", dest="sitemap", action="store_false", help="do not seed from sitemap.xml")
+    parser.add_argument("--no-follow", dest="follow_links", action="store_false",
+                        help="only fetch the start page and the pages the sitemaps list")
+    args = parser.parse_args()
+
+    crawl(args.url, max_depth=args.max_depth, max_pages=args.max_pages, order=args.order, sitemap=args.sitemap,
+          follow_links=args.follow_links)
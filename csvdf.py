@@ -1,95 +1,129 @@
-# Purpose: Convert Site, Github (Go initially) input files to Pandas DataFrame
-# with embeddings column
+# Purpose: Convert Site, Github (Go initially) input files into a topic store of chunks
+# with embeddings, streaming them through walk -> clean -> chunk -> embed -> append stages.
+# Each source of the config gets a shard of its own, so one source can be re-ingested alone.
+import argparse
+import hashlib
 import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
 from urllib.parse import urlparse
-import tiktoken
+import numpy as np
 import pandas as pd
-import openai
+
+import instrument
+from ann import build_index
+from chunker import chunk_document
+from dedup import BoilerplateIndex, Deduplicator, boilerplate_digest, strip_boilerplate
+from embedder import EMBEDDING_MODEL, embed_texts
+from embedding_cache import EmbeddingCache, cache_key
+from lexical import build_lexical
+from pipeline import batched, threaded
+from quantize import refresh_quantized
+from source_walker import MAX_FILE_SIZE, load_manifest, read_files, save_manifest, scan
+from store import (StoreWriter, iter_store_batches, load_shards, remove_store, save_shards, shard_name, store_columns,
+                   store_paths)
 
 CRAWLED_PAGES = "output/"
 IGNORE_TEST_FILES = False
 
+# Chunks embedded and appended to the store at a time, the unit of memory use and of resuming
+FLUSH_CHUNKS = 2048
 
-def remove_newlines(content):
-    content = content.str.replace('\n', ' ')
-    content = content.str.replace('\\n', ' ')
-    content = content.str.replace('  ', ' ')
-    content = content.str.replace('  ', ' ')
-    return content
-
-
-def process_git_folder(git_folder_path, ignore_test_files=True):
-    texts = []
-
-    for root, _, files in os.walk(git_folder_path):
-        for file in files:
-            if file != "bindata.go" and not file.endswith("pb.go") and file.endswith(".go"):
-                # Ignore test files if the flag is set to True
-                if ignore_test_files and file.endswith("_test.go"):
-                    continue
-
-                file_path = os.path.join(root, file)
-
-                with open(file_path, "r", encoding="UTF-8") as go_file:
-                    go_content = go_file.read()
-
-                    # Skip files that are too long or contain null bytes
-                    size = len(go_content)
-                    if size > 120000:
-                        continue
+# Documents handed to the chunking process pool at a time, CHUNK_PROCESSES = 1 chunks in process
+CHUNK_BATCH = 256
+CHUNK_PROCESSES = None
 
-                    texts.append((file, go_content))
+CHUNK_COLUMNS = ['text', 'n_tokens', 'title', 'root', 'source']
 
-    # Create a dataframe from the list of texts
-    data_frame = pd.DataFrame(texts, columns=['fname', 'text'])
-
-    # Set the code text column to be the raw code text with the newlines removed
-    data_frame['text'] = data_frame.fname + ". " + remove_newlines(data_frame.text)
-
-    return data_frame
-
-
-def process_website(url):
-    domain = urlparse(url).hostname
-
-    # Create a list to store the web text files
-    texts = []
-
-    # Get all the web text files in the web text directory
-    for file in os.listdir(CRAWLED_PAGES + domain + "/"):
-        # Open the file and read the web text
-        with open(CRAWLED_PAGES + domain + "/" + file, "r", encoding="UTF-8") as web_file:
-            web_text = web_file.read()
-            clean_filename = file
-            if file == "_.txt":
-                clean_filename = "index"
-            elif file == ".txt" or 'policy' in file or 'cgi' in file or 'php' in file or 'asp' in file or \
-                    'aspx' in file or 'legal' in file or 'gateway-terms' in file or 'website-terms-conditions' in file:
-                continue
-            else:
-                # Remove leading and trailing underscores
-                clean_filename = file.strip('_')
 
-                # Remove the prefix '_docs_' and postfix '_.txt' or '_.html'
-                clean_filename = clean_filename.replace('_docs_', '', 1)  # Remove prefix '_docs_' once
-                clean_filename = clean_filename.replace('_.txt', '')  # Remove postfix '_.txt'
-                clean_filename = clean_filename.replace('.txt', '')  # Remove postfix '_.txt'
-                clean_filename = clean_filename.replace('.html.txt', '')  # Remove postfix '_.html'
-                clean_filename = clean_filename.replace('.html', '')  # Remove postfix '_.html'
+def remove_newlines(content):
+    content = content.replace('\n', ' ')
+    content = content.replace('\\n', ' ')
+    content = content.replace('  ', ' ')
+    content = content.replace('  ', ' ')
+    return content
 
-            # print('file:', file, ", ", clean_filename)
-            texts.append((clean_filename, web_text))
 
-    # Create a dataframe from the list of texts
-    data_frame = pd.DataFrame(texts, columns=['fname', 'text'])
+def process_git_folder(git_folder_path, to_read, entries):
+    """
+    Yield a (fname, text, source) document for each file of a scan, adding their manifest entries to entries
+    """
+    for rel_path, go_content in read_files(git_folder_path, to_read, entries, max_size=MAX_FILE_SIZE):
+        fname = os.path.basename(rel_path)
+
+        # Set the code text to be the raw code text with the newlines removed
+        yield fname, fname + ". " + remove_newlines(go_content), rel_path
+
+
+def website_folder(url):
+    return CRAWLED_PAGES + urlparse(url).hostname + "/"
+
+
+def website_title(file):
+    """
+    Return the title of a crawled page from its file name, or None if the page is skipped
+    """
+    if file == "_.txt":
+        return "index"
+    elif file == ".txt" or 'policy' in file or 'cgi' in file or 'php' in file or 'asp' in file or \
+            'aspx' in file or 'legal' in file or 'gateway-terms' in file or 'website-terms-conditions' in file:
+        return None
+
+    # Remove leading and trailing underscores
+    clean_filename = file.strip('_')
+
+    # Remove the prefix '_docs_' and postfix '_.txt' or '_.html'
+    clean_filename = clean_filename.replace('_docs_', '', 1)  # Remove prefix '_docs_' once
+    clean_filename = clean_filename.replace('_.txt', '')  # Remove postfix '_.txt'
+    clean_filename = clean_filename.replace('.txt', '')  # Remove postfix '_.txt'
+    clean_filename = clean_filename.replace('.html.txt', '')  # Remove postfix '_.html'
+    clean_filename = clean_filename.replace('.html', '')  # Remove postfix '_.html'
+    return clean_filename
+
+
+def site_boilerplate(topic, url, scanned):
+    """
+    Return the lines repeated on most pages of a crawled site (navigation, footers), counting only the
+    pages that changed since the last ingest, their digest and the scan of the site. When they differ
+    from the ones the topic stripped last time the scan covers every page, so all are cleaned alike.
+    """
+    to_read, unchanged, deleted = scanned
+    folder = website_folder(url)
+    index = BoilerplateIndex(folder)
+    try:
+        changed = [rel_path for rel_path, _ in to_read]
+        index.sync(list(unchanged) + changed, changed)
+        boilerplate = index.lines()
+        digest = boilerplate_digest(boilerplate)
+        stale = index.applied(topic) != digest
+    finally:
+        index.close()
+
+    if stale and unchanged:
+        print(f"{url}: boilerplate changed, cleaning all {len(unchanged) + len(to_read)} pages again")
+        to_read, _, _ = scan(folder, None, include=["*.txt"], exclude=[], ignore_test_files=False)
+        scanned = to_read, {}, deleted
+    return boilerplate, digest, scanned
+
+
+def process_website(url, to_read, entries, boilerplate):
+    """
+    Yield a (fname, text, source) document for each crawled page of a scan, adding their manifest
+    entries to entries. The boilerplate lines are dropped.
+    """
+    for file, web_text in read_files(website_folder(url), to_read, entries):
+        clean_filename = website_title(file)
+        if clean_filename is None:
+            continue
 
-    # Set the web_text column to be the raw web_text with the newlines removed
-    data_frame['text'] = data_frame.fname + ". " + remove_newlines(data_frame.text)
+        web_text, removed = strip_boilerplate(web_text, boilerplate)
+        instrument.count("ingest.boilerplate_lines", removed)
 
-    return data_frame
+        # Set the web text to be the raw web text with the newlines removed
+        yield clean_filename, clean_filename + ". " + remove_newlines(web_text), file
 
 
 def is_url(url):
@@ -97,135 +131,337 @@ def is_url(url):
     return bool(pattern.match(url))
 
 
-if len(sys.argv) != 2:
-    print("Usage: python main.py <config_file>")
-    sys.exit(1)
-
-config_file = sys.argv[1]
-
-# Read the configuration file
-with open(config_file, "r") as f:
-    config_lines = [line.strip() for line in f.readlines()]
-
-# Remove empty lines
-config_lines = [line for line in config_lines if line]
-
-# Check if the topic property exists
-topic = None
-for line in config_lines:
-    if line.startswith("topic:"):
-        topic = line.split(":", 1)[1].strip()
-        break
-
-if topic is None:
-    print("Error: The topic property does not exist in the config file.")
-    sys.exit(1)
-
-# Process each configuration line (website URL or local Git folder path)
-dfs = []
-# Initialize a flag to check if the topic line has been processed
-topic_line_read = False
-for line in config_lines:
-    if not topic_line_read:
-        # Ignore the first non-empty line, which is the topic line
-        topic_line_read = True
-        continue
-
-    if is_url(line):
-        print("Processing website: " + line + "...")
-        df = process_website(line)
-        dfs.append(df)
-    else:
-        print("Processing Git folder: " + line + "...")
-        df = process_git_folder(line, )
-        dfs.append(df)
-
-# Combine all data frames
-combined_df = pd.concat(dfs, ignore_index=True)
-csv_filename = f"processed/{topic}.csv"
-combined_df.to_csv(csv_filename)
-print(f"Saved combined data frames to {csv_filename}")
-
-# Tokenize
-# Load the cl100k_base tokenizer which is designed to work with the ada-002 model
-tokenizer = tiktoken.get_encoding("cl100k_base")
-
-df = pd.read_csv(csv_filename, index_col=0)
-df.columns = ['title', 'text']
-
-# Tokenize the text and save the number of tokens to a new column
-df['n_tokens'] = df.text.apply(lambda x: len(tokenizer.encode(x)))
-
-# Visualize the distribution of the number of tokens per row using a histogram
-df.n_tokens.hist()
-
-MAX_TOKENS = 500
-
-
-# Function to split the text into chunks of a maximum number of tokens
-def split_into_many(text, max_tokens_in=MAX_TOKENS):
-    # Split the text into sentences
-    sentences = text.split('. ')
-
-    # Get the number of tokens for each sentence
-    n_tokens = [len(tokenizer.encode(" " + sentence)) for sentence in sentences]
-
-    chunks = []
-    tokens_so_far = 0
-    chunk = []
-
-    # Loop through the sentences and tokens joined together in a tuple
-    for sentence, token in zip(sentences, n_tokens):
-
-        # If the number of tokens so far plus the number of tokens in the current sentence is greater
-        # than the max number of tokens, then add the chunk to the list of chunks and reset
-        # the chunk and tokens so far
-        if tokens_so_far + token > max_tokens_in:
-            chunks.append(". ".join(chunk) + ".")
-            chunk = []
-            tokens_so_far = 0
-
-        # If the number of tokens in the current sentence is greater than the max number of
-        # tokens, go to the next sentence
-        if token > max_tokens_in:
+def read_config(config_file):
+    """
+    Return the topic, the list of sources (website URLs or local Git folder paths) and the walker
+    settings of a config file. `include:` and `exclude:` lines take comma separated globs for the
+    Git folder files, `use_git: true` lists them with git ls-files.
+    """
+    # Read the configuration file
+    with open(config_file, "r") as f:
+        config_lines = [line.strip() for line in f.readlines()]
+
+    # Remove empty lines
+    config_lines = [line for line in config_lines if line]
+
+    # Check if the topic property exists
+    topic = None
+    for line in config_lines:
+        if line.startswith("topic:"):
+            topic = line.split(":", 1)[1].strip()
+            break
+
+    if topic is None:
+        print("Error: The topic property does not exist in the config file.")
+        sys.exit(1)
+
+    # Ignore the first non-empty line, which is the topic line
+    sources = []
+    settings = {}
+    for line in config_lines[1:]:
+        key, _, value = line.partition(":")
+        if key in ("include", "exclude"):
+            settings[key] = [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+        elif key == "use_git":
+            settings[key] = value.strip().lower() == "true"
+        else:
+            sources.append(line)
+
+    return topic, sources, settings
+
+
+def scan_sources(sources, settings, previous_manifest):
+    """
+    Scan every source without reading files. Returns {source: (to_read, unchanged entries, deleted)}.
+    """
+    scans = {}
+    for line in sources:
+        if is_url(line):
+            scans[line] = scan(website_folder(line), previous_manifest.get(line), include=["*.txt"], exclude=[],
+                               ignore_test_files=False)
+        else:
+            scans[line] = scan(line, previous_manifest.get(line), settings.get("include"), settings.get("exclude"),
+                               use_git=settings.get("use_git", False))
+        to_read, _, deleted = scans[line]
+        print(f"{line}: {len(to_read)} new or modified and {len(deleted)} deleted files")
+    return scans
+
+
+def scan_digest(config_file, topic, scans):
+    """
+    Fingerprint of the inputs of an ingest run, an interrupted run only resumes if it is unchanged
+    """
+    digest = hashlib.sha256()
+    with open(config_file, "rb") as f:
+        digest.update(f.read())
+    matrix_path, _ = store_paths(topic)
+    if os.path.exists(matrix_path):
+        digest.update(str(os.stat(matrix_path).st_mtime_ns).encode())
+    for line, (to_read, _, deleted) in scans.items():
+        digest.update(line.encode("UTF-8"))
+        for rel_path, stat in to_read:
+            digest.update(f"{rel_path}\0{stat.st_mtime_ns}\0{stat.st_size}\n".encode("UTF-8"))
+        digest.update("\0".join(deleted).encode("UTF-8"))
+    return digest.hexdigest()
+
+
+def iter_units(topic, scans, carry_over, manifest, boilerplate, previous_manifest):
+    """
+    Yield the input units of the pipeline in a deterministic order: first ('chunks', DataFrame, embeddings)
+    batches of the previous store's chunks of unchanged files, then ('doc', root, document) for every
+    new or modified file, and last the previous store's chunks of the files that were touched but whose
+    content hash did not change
+    """
+    if carry_over:
+        stale = {line: {rel_path for rel_path, _ in to_read} | set(deleted)
+                 for line, (to_read, _, deleted) in scans.items()}
+        for meta, embeddings in iter_store_batches(topic, FLUSH_CHUNKS):
+            keep = np.array([root in stale and source not in stale[root]
+                             for root, source in zip(meta.root, meta.source)], dtype=bool)
+            yield 'chunks', meta[keep], embeddings[keep]
+
+    same = {}
+    for line, (to_read, _, _) in scans.items():
+        previous = previous_manifest.get(line, {})
+        same[line] = set()
+        documents = process_website(line, to_read, manifest[line], boilerplate[line]) if is_url(line) else \
+            process_git_folder(line, to_read, manifest[line])
+        for document in documents:
+            source = document[2]
+            if source in previous and previous[source][2] == manifest[line][source][2]:
+                same[line].add(source)
+                continue
+            yield 'doc', line, document
+
+    if carry_over and any(same.values()):
+        for meta, embeddings in iter_store_batches(topic, FLUSH_CHUNKS):
+            keep = np.array([root in same and source in same[root]
+                             for root, source in zip(meta.root, meta.source)], dtype=bool)
+            if keep.any():
+                yield 'chunks', meta[keep], embeddings[keep]
+
+
+def chunk_documents(documents, executor=None):
+    """
+    Chunk ('doc', root, document) units into a DataFrame of chunk rows and their document token counts
+    """
+    texts = [text for _, _, (_, text, _) in documents]
+    chunked = executor.map(chunk_document, texts, chunksize=16) if executor else map(chunk_document, texts)
+
+    rows = []
+    doc_tokens = []
+    for (_, root, (fname, _, source)), (n_tokens, chunks) in zip(documents, chunked):
+        doc_tokens.append(n_tokens)
+        rows.extend((text, tokens, fname, root, source) for text, tokens in chunks)
+    return pd.DataFrame(rows, columns=CHUNK_COLUMNS), doc_tokens
+
+
+def chunk_units(units, executor=None):
+    """
+    Chunk the documents among the units in batches, across the process pool if there is one. Yields
+    (chunk rows DataFrame, their embeddings or None if they still need them, document token counts,
+    number of units consumed) in the order of the units, so a resumed run skips the right ones.
+    """
+    for batch in batched(units, CHUNK_BATCH):
+        documents = []
+        for unit in batch:
+            if unit[0] == 'chunks':
+                if documents:
+                    meta, doc_tokens = chunk_documents(documents, executor)
+                    yield meta, None, doc_tokens, len(documents)
+                    documents = []
+                _, meta, embeddings = unit
+                yield meta[CHUNK_COLUMNS], embeddings, [], 1
+            else:
+                documents.append(unit)
+
+        if documents:
+            meta, doc_tokens = chunk_documents(documents, executor)
+            yield meta, None, doc_tokens, len(documents)
+
+
+def dedup_chunks(batches, deduplicator):
+    """
+    Drop the new chunks that duplicate an earlier chunk, exactly or nearly, before they are embedded.
+    Carried over chunks are only remembered.
+    """
+    for meta, embeddings, doc_tokens, consumed in batches:
+        if embeddings is None:
+            keep = deduplicator.keep_mask(meta.text, meta.n_tokens)
+            instrument.count("ingest.duplicate_chunks", int(len(meta) - keep.sum()))
+            instrument.count("ingest.duplicate_tokens", int(meta.n_tokens[~keep].sum()))
+            meta = meta[keep].reset_index(drop=True)
+        else:
+            for text in meta.text:
+                deduplicator.add_exact(text)
+        yield meta, embeddings, doc_tokens, consumed
+
+
+def ingest(topic, sources, settings, config_file, previous=None):
+    """
+    Build the store of a topic from sources, carrying over the chunks of unchanged files from its
+    previous store, or from the store previous when it has none yet. Returns the token counts of the
+    documents read and of all the chunks of the new store.
+    """
+    # Chunks of files unchanged since the last run are carried over from the previous store, which
+    # needs to know the source of each chunk
+    base = topic if store_columns(topic) is not None or previous is None else previous
+    columns = store_columns(base)
+    carry_over = columns is not None and 'root' in columns and 'source' in columns
+    previous_manifest = load_manifest(base) if carry_over else {}
+
+    with instrument.stage("ingest.scan"):
+        scans = scan_sources(sources, settings, previous_manifest)
+
+    # Boilerplate of the crawled sites, updated from the pages that changed
+    boilerplate = {}
+    digests = {}
+    with instrument.stage("ingest.boilerplate"):
+        for line in sources:
+            if is_url(line):
+                scanned = scans[line]
+                boilerplate[line], digests[line], scans[line] = site_boilerplate(topic, line, scanned)
+                if scans[line] is not scanned:
+                    # Pages cleaned of other boilerplate than last time cannot reuse their chunks
+                    previous_manifest.pop(line, None)
+    manifest = {line: dict(unchanged) for line, (_, unchanged, _) in scans.items()}
+
+    # Flushed batches are checkpointed, an interrupted run with the same inputs resumes after the last one
+    writer = StoreWriter(topic, scan_digest(config_file, base, scans))
+    cache = EmbeddingCache()
+    deduplicator = Deduplicator()
+    doc_tokens = []
+    pending = []
+
+    def flush(units_done):
+        if not pending:
+            return
+
+        # Only the new chunks missing from the embedding cache are sent to the API, in batched,
+        # concurrent requests paced under the rate limits
+        texts = []
+        n_tokens = []
+        for meta, embeddings in pending:
+            if embeddings is None:
+                texts.extend(meta.text)
+                n_tokens.extend(meta.n_tokens)
+        with instrument.stage("ingest.embed"):
+            fresh = iter(embed_texts(texts, n_tokens, cache=cache) if texts else [])
+
+        embeddings = []
+        for meta, carried in pending:
+            embeddings.extend(islice(fresh, len(meta)) if carried is None else carried)
+
+        with instrument.stage("ingest.store"):
+            writer.append(pd.concat([meta for meta, _ in pending], ignore_index=True), embeddings, units_done)
+        pending.clear()
+
+    # walk -> clean -> chunk -> dedup -> embed -> append, each stage handing over to the next through a bounded
+    # queue. Units already flushed by an interrupted run are skipped before chunking. Each stage is
+    # timed by the work it does in its own thread.
+    units = islice(threaded(instrument.timed_iter("ingest.walk", iter_units(base, scans, carry_over, manifest,
+                                                                         boilerplate, previous_manifest))),
+                   writer.units_done, None)
+    units_done = writer.units_done
+    executor = ProcessPoolExecutor(max_workers=CHUNK_PROCESSES) if CHUNK_PROCESSES != 1 else None
+    try:
+        chunked = threaded(instrument.timed_iter("ingest.chunk", chunk_units(units, executor)))
+        for meta, embeddings, tokens, consumed in threaded(instrument.timed_iter("ingest.dedup",
+                                                                                 dedup_chunks(chunked, deduplicator))):
+            pending.append((meta, embeddings))
+            doc_tokens.extend(tokens)
+            units_done += consumed
+            instrument.count("ingest.chunks" if embeddings is None else "ingest.chunks_carried", len(meta))
+            instrument.count("ingest.documents", len(tokens))
+            instrument.count("ingest.document_tokens", sum(tokens))
+            if sum(len(meta) for meta, _ in pending) >= FLUSH_CHUNKS:
+                flush(units_done)
+        flush(units_done)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print("Completed tokenization and embedding.")
+    print(f"Dedup: {deduplicator.stats()}")
+
+    # Save the embeddings as a float32 matrix next to the chunk text and token counts
+    with instrument.stage("ingest.store"):
+        matrix_filename, chunks_filename = writer.finish()
+    print(f"Saved embeddings to {matrix_filename} and chunks to {chunks_filename}")
+
+    # Record the chunks this topic uses so `python embedding_cache.py compact` keeps them
+    keys = []
+    chunk_tokens = []
+    for meta, _ in iter_store_batches(topic, FLUSH_CHUNKS, columns=['text', 'n_tokens']):
+        keys.extend(cache_key(text, EMBEDDING_MODEL) for text in meta.text)
+        chunk_tokens.extend(meta.n_tokens)
+    cache.set_topic_refs(topic, keys)
+    print(f"Embedding cache: {cache.stats()}")
+    cache.close()
+
+    # Large topics get an approximate nearest-neighbour index, small ones are searched exactly. Every
+    # topic gets a BM25 index for identifier lookups and hybrid retrieval.
+    with instrument.stage("ingest.index"):
+        build_index(topic)
+        refresh_quantized(topic)
+        build_lexical(topic)
+
+    # Only now that the topic is saved can the next run skip the files read in this one
+    save_manifest(topic, manifest)
+    for line, digest in digests.items():
+        index = BoilerplateIndex(website_folder(line))
+        index.set_applied(topic, digest)
+        index.close()
+    return doc_tokens, chunk_tokens
+
+
+def main(config_file, only=None):
+    """
+    Ingest every source of a config, or only the ones in only, into its own shard of the topic. The
+    shards of the other sources are left as they are.
+    """
+    topic, sources, settings = read_config(config_file)
+    if only:
+        unknown = [line for line in only if line not in sources]
+        if unknown:
+            print(f"Error: {', '.join(unknown)} not in {config_file}.")
+            sys.exit(1)
+
+    shards = {line: shard_name(topic, line) for line in sources}
+    doc_tokens = []
+    chunk_tokens = []
+    for line in sources:
+        if only and line not in only:
             continue
-
-        # Otherwise, add the sentence to the chunk and add the number of tokens to the total
-        chunk.append(sentence)
-        tokens_so_far += token + 1
-
-    return chunks
-
-
-shortened = []
-
-# Loop through the dataframe
-for row in df.iterrows():
-
-    # If the text is None, go to the next row
-    if row[1]['text'] is None:
-        continue
-
-    # If the number of tokens is greater than the max number of tokens, split the text into chunks
-    if row[1]['n_tokens'] > MAX_TOKENS:
-        shortened += split_into_many(row[1]['text'])
-
-    # Otherwise, add the text to the list of shortened texts
-    else:
-        shortened.append(row[1]['text'])
-
-df = pd.DataFrame(shortened, columns=['text'])
-df['n_tokens'] = df.text.apply(lambda x: len(tokenizer.encode(x)))
-print(df.n_tokens.hist())
-
-print("Completed tokenization.")
-
-# Note that you may run into rate limit issues depending on how many files you try to embed Please check out our rate
-# limit guide to learn more on how to handle this: https://platform.openai.com/docs/guides/rate-limits
-
-embeddings_filename = f"processed/{topic}_embeddings.csv"
-df['embeddings'] = df.text.apply(
-    lambda x: openai.Embedding.create(input=x, engine='text-embedding-ada-002')['data'][0]['embedding'])
-df.to_csv(embeddings_filename)
-print(f"Saved combined data frames to {embeddings_filename}")
-print(df.head())
+        print(f"Ingesting {line} into {shards[line]}")
+
+        # A topic stored in one piece by an earlier version seeds its new shards with its chunks
+        shard_doc_tokens, shard_chunk_tokens = ingest(shards[line], [line], settings, config_file, previous=topic)
+        doc_tokens.extend(shard_doc_tokens)
+        chunk_tokens.extend(shard_chunk_tokens)
+
+    # The shards of sources removed from the config go away with them
+    cache = EmbeddingCache()
+    for line, shard in (load_shards(topic) or {}).items():
+        if line not in shards:
+            print(f"Removing {shard}, {line} is no longer a source")
+            remove_store(shard)
+            cache.drop_topic(shard)
+    cache.close()
+    save_shards(topic, shards)
+
+    # Visualize the distribution of the number of tokens per document and per chunk using histograms
+    pd.Series(doc_tokens, dtype=int).hist()
+    print(pd.Series(chunk_tokens, dtype=int).hist())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest the sources of a config into the shards of its topic")
+    parser.add_argument("config_file")
+    parser.add_argument("--source", action="append", metavar="SOURCE",
+                        help="only re-ingest this source (URL or folder as written in the config), repeatable")
+    args = parser.parse_args()
+
+    with instrument.stage("ingest"):
+        main(args.config_file, args.source)
+    instrument.write_report(config=args.config_file)
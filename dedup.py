@@ -0,0 +1,212 @@
+# Purpose: Drop duplicate content before it is embedded: lines repeated on most pages of a crawled
+# domain (navigation, headers, footers), chunks identical to an earlier chunk, and chunks nearly
+# identical to one according to MinHash signatures bucketed with LSH
+import hashlib
+import os
+import sqlite3
+import zlib
+
+import numpy as np
+
+# A line is boilerplate when it appears on at least this share of a domain's pages, once the domain
+# has enough pages to tell
+BOILERPLATE_SHARE = 0.5
+BOILERPLATE_MIN_PAGES = 5
+
+# Per-domain line counts of the crawled pages, see BoilerplateIndex
+BOILERPLATE_DIR = "processed/boilerplate/"
+
+# Words per shingle, MinHash permutations and LSH bands (rows per band = NUM_PERM // LSH_BANDS)
+SHINGLE_WORDS = 5
+NUM_PERM = 64
+LSH_BANDS = 16
+
+# Estimated Jaccard similarity above which an LSH candidate counts as a near duplicate
+NEAR_DUPLICATE_JACCARD = 0.8
+
+# Mersenne prime larger than the 32-bit shingle hashes, so (a * x + b) % p never overflows 64 bits
+_PRIME = (1 << 61) - 1
+_rng = np.random.default_rng(1)
+_A = _rng.integers(1, 1 << 31, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, 1 << 31, NUM_PERM, dtype=np.uint64)
+
+
+def _line_hash(line):
+    # 64-bit signed, the widest integer SQLite stores
+    return int.from_bytes(hashlib.blake2b(line.encode("UTF-8"), digest_size=8).digest(), "little", signed=True)
+
+
+class BoilerplateIndex:
+    """
+    SQLite-backed counts of the pages of a crawled domain each distinct stripped line appears on. The
+    line hashes of every page are kept too, so a page that changed or went away is uncounted without
+    re-reading the others, and memory does not grow with the size of the site. Each topic ingesting the
+    domain records a digest of the boilerplate it stripped, to tell when its pages must be cleaned again.
+    """
+
+    def __init__(self, folder, state_dir=BOILERPLATE_DIR):
+        os.makedirs(state_dir, exist_ok=True)
+        self.folder = folder
+        self.conn = sqlite3.connect(f"{state_dir}{os.path.basename(os.path.normpath(folder))}.sqlite")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (page TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS lines (hash INTEGER PRIMARY KEY, text TEXT NOT NULL, pages INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS page_lines (page TEXT NOT NULL, hash INTEGER NOT NULL,
+                PRIMARY KEY (page, hash)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS applied (topic TEXT PRIMARY KEY, digest TEXT NOT NULL);
+        """)
+        self.conn.commit()
+
+    def _uncount(self, page, hashes):
+        self.conn.executemany("UPDATE lines SET pages = pages - 1 WHERE hash = ?", [(h,) for h in hashes])
+        self.conn.executemany("DELETE FROM page_lines WHERE page = ? AND hash = ?", [(page, h) for h in hashes])
+
+    def remove(self, page):
+        self._uncount(page, [row[0] for row in self.conn.execute("SELECT hash FROM page_lines WHERE page = ?",
+                                                                 (page,))])
+        self.conn.execute("DELETE FROM pages WHERE page = ?", (page,))
+
+    def update(self, page):
+        """
+        Count the lines of a page (a .txt file relative to the folder) in place of its previous version
+        """
+        try:
+            with open(os.path.join(self.folder, page), "r", encoding="UTF-8") as f:
+                lines = {_line_hash(line): line for line in {line.strip() for line in f} if line}
+        except (OSError, UnicodeDecodeError):
+            self.remove(page)
+            return
+
+        old = {row[0] for row in self.conn.execute("SELECT hash FROM page_lines WHERE page = ?", (page,))}
+        self._uncount(page, old - lines.keys())
+        added = [(h, lines[h]) for h in lines.keys() - old]
+        self.conn.executemany("INSERT OR IGNORE INTO lines (hash, text, pages) VALUES (?, ?, 0)", added)
+        self.conn.executemany("UPDATE lines SET pages = pages + 1 WHERE hash = ?", [(h,) for h, _ in added])
+        self.conn.executemany("INSERT INTO page_lines (page, hash) VALUES (?, ?)", [(page, h) for h, _ in added])
+        self.conn.execute("INSERT OR IGNORE INTO pages (page) VALUES (?)", (page,))
+
+    def sync(self, pages, changed):
+        """
+        Bring the counts up to date with the current pages of the folder: the changed ones and the ones
+        never counted are read, the ones no longer there uncounted
+        """
+        pages = set(pages)
+        known = {row[0] for row in self.conn.execute("SELECT page FROM pages")}
+        with self.conn:
+            for page in known - pages:
+                self.remove(page)
+            for page in (set(changed) & pages) | (pages - known):
+                self.update(page)
+            self.conn.execute("DELETE FROM lines WHERE pages <= 0")
+
+    def lines(self, share=BOILERPLATE_SHARE, min_pages=BOILERPLATE_MIN_PAGES):
+        """
+        Set of the stripped lines that appear on at least share of the pages
+        """
+        pages = self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        if pages < min_pages:
+            return set()
+        return {row[0] for row in self.conn.execute("SELECT text FROM lines WHERE pages >= ?", (share * pages,))}
+
+    def applied(self, topic):
+        row = self.conn.execute("SELECT digest FROM applied WHERE topic = ?", (topic,)).fetchone()
+        return row[0] if row else None
+
+    def set_applied(self, topic, digest):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO applied (topic, digest) VALUES (?, ?)", (topic, digest))
+
+    def close(self):
+        self.conn.close()
+
+
+def boilerplate_digest(boilerplate):
+    return hashlib.sha256("\n".join(sorted(boilerplate)).encode("UTF-8")).hexdigest()
+
+
+def strip_boilerplate(text, boilerplate):
+    """
+    Remove the boilerplate lines of a page, returning the text and the number of lines removed
+    """
+    if not boilerplate:
+        return text, 0
+    lines = text.splitlines()
+    kept = [line for line in lines if line.strip() not in boilerplate]
+    return "\n".join(kept), len(lines) - len(kept)
+
+
+def normalize_text(text):
+    return " ".join(text.lower().split())
+
+
+def minhash(text):
+    """
+    MinHash signature of the word shingles of a text as NUM_PERM uint32 values
+    """
+    words = normalize_text(text).split()
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    hashes = np.fromiter((zlib.crc32(shingle.encode("UTF-8")) for shingle in shingles), dtype=np.uint64,
+                         count=len(shingles))
+    # Only the low 32 bits are kept, enough to compare signatures at half the memory
+    return ((np.outer(hashes, _A) + _B) % _PRIME).min(axis=0).astype(np.uint32)
+
+
+class Deduplicator:
+    """
+    Remembers the chunks it has seen and tells whether a new chunk is an exact or near duplicate of one
+    of them. Keeps counts of what was dropped.
+    """
+
+    def __init__(self, threshold=NEAR_DUPLICATE_JACCARD, bands=LSH_BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = NUM_PERM // bands
+        self.exact = set()
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = []
+        self.exact_dropped = 0
+        self.near_dropped = 0
+        self.tokens_saved = 0
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add_exact(self, text):
+        """
+        Remember a chunk kept by an earlier ingest without checking it. Only its exact hash is kept,
+        signing every carried over chunk would cost more than the near duplicates it could catch.
+        """
+        self.exact.add(hashlib.sha1(normalize_text(text).encode("UTF-8")).digest())
+
+    def is_duplicate(self, text, n_tokens=0):
+        """
+        Check a chunk against the ones seen so far and remember it when it is new
+        """
+        digest = hashlib.sha1(normalize_text(text).encode("UTF-8")).digest()
+        if digest in self.exact:
+            self.exact_dropped += 1
+            self.tokens_saved += n_tokens
+            return True
+
+        signature = minhash(text)
+        keys = self._band_keys(signature)
+        candidates = {bucket[key] for bucket, key in zip(self.buckets, keys) if key in bucket}
+        for candidate in candidates:
+            if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                self.near_dropped += 1
+                self.tokens_saved += n_tokens
+                return True
+
+        self.exact.add(digest)
+        for bucket, key in zip(self.buckets, keys):
+            bucket.setdefault(key, len(self.signatures))
+        self.signatures.append(signature)
+        return False
+
+    def keep_mask(self, texts, n_tokens):
+        return np.array([not self.is_duplicate(text, tokens) for text, tokens in zip(texts, n_tokens)], dtype=bool)
+
+    def stats(self):
+        return (f"dropped {self.exact_dropped} exact and {self.near_dropped} near duplicate chunks, "
+                f"saving {self.tokens_saved} tokens")
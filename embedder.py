@@ -0,0 +1,191 @@
+# Purpose: Embed text chunks in batched, concurrent requests paced to stay under the
+# OpenAI rate limits
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import openai
+
+import instrument
+from embedding_cache import cache_key
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Pack chunks into each request up to these limits (ada-002 accepts up to 2048 inputs per request)
+MAX_BATCH_TOKENS = 50000
+MAX_BATCH_SIZE = 2048
+
+# Number of requests kept in flight at the same time
+MAX_WORKERS = 4
+
+# Default account limits for ada-002, see https://platform.openai.com/docs/guides/rate-limits
+TOKENS_PER_MINUTE = 1000000
+REQUESTS_PER_MINUTE = 3000
+
+MAX_RETRIES = 6
+
+# Errors worth retrying, only the rate limit error slows down the pacing
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `per_minute` units per minute.
+    The rate is halved on every rate limit error and recovers slowly on success.
+    """
+
+    def __init__(self, per_minute):
+        self.max_rate = per_minute / 60.0
+        self.rate = self.max_rate
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        # A single request larger than the bucket would never fit, so cap it to the capacity
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+            self.tokens = 0.0
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+def openai_embed(texts, model=EMBEDDING_MODEL):
+    """
+    Embed a list of texts with a single OpenAI request and return the embeddings in input order
+    """
+    response = openai.Embedding.create(input=texts, engine=model)
+    data = sorted(response['data'], key=lambda d: d['index'])
+    return [d['embedding'] for d in data]
+
+
+def make_batches(n_tokens, max_batch_tokens=MAX_BATCH_TOKENS, max_batch_size=MAX_BATCH_SIZE):
+    """
+    Group consecutive row positions into batches that fit the token and size budgets
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i, tokens in enumerate(n_tokens):
+        if batch and (batch_tokens + tokens > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def embed_texts(texts, n_tokens=None, embed_fn=openai_embed, model=EMBEDDING_MODEL,
+                max_batch_tokens=MAX_BATCH_TOKENS, max_batch_size=MAX_BATCH_SIZE, max_workers=MAX_WORKERS,
+                tokens_per_minute=TOKENS_PER_MINUTE, requests_per_minute=REQUESTS_PER_MINUTE,
+                max_retries=MAX_RETRIES, cache=None):
+    """
+    Embed all texts with batched requests running concurrently and return the embeddings in the same
+    order as the texts. `embed_fn(texts, model)` does the actual call and can be swapped for a fake.
+    With an EmbeddingCache only the texts missing from the cache are sent to the API.
+    """
+    texts = list(texts)
+    if n_tokens is None:
+        # Rough estimate of ~4 characters per token when the counts are not known
+        n_tokens = [len(text) // 4 + 1 for text in texts]
+    n_tokens = list(n_tokens)
+    results = [None] * len(texts)
+
+    # Fill in the cached embeddings first and only embed the misses
+    todo = list(range(len(texts)))
+    keys = None
+    if cache is not None:
+        keys = [cache_key(text, model) for text in texts]
+        found = cache.get_many(keys)
+        todo = [i for i in todo if keys[i] not in found]
+        for i, key in enumerate(keys):
+            if key in found:
+                results[i] = found[key]
+        cache.hits += len(texts) - len(todo)
+        cache.misses += len(todo)
+        instrument.count("embedding_cache.hits", len(texts) - len(todo))
+        instrument.count("embedding_cache.misses", len(todo))
+        print(f"Embedding cache: {cache.stats()}")
+
+    token_bucket = TokenBucket(tokens_per_minute)
+    request_bucket = TokenBucket(requests_per_minute)
+
+    def run_batch(batch):
+        batch_texts = [texts[i] for i in batch]
+        batch_tokens = sum(n_tokens[i] for i in batch)
+        for attempt in range(max_retries + 1):
+            request_bucket.acquire()
+            token_bucket.acquire(batch_tokens)
+            started = time.perf_counter()
+            try:
+                embeddings = embed_fn(batch_texts, model)
+            except RETRYABLE_ERRORS as e:
+                instrument.count("openai.embedding.errors")
+                if attempt == max_retries:
+                    raise
+                instrument.count("openai.embedding.retries")
+                if isinstance(e, openai.error.RateLimitError):
+                    instrument.count("openai.embedding.rate_limited")
+                    token_bucket.slow_down()
+                    request_bucket.slow_down()
+                # Exponential backoff with jitter before retrying the same batch
+                time.sleep(min(60.0, 2 ** attempt) * (0.5 + random.random()))
+                continue
+
+            instrument.observe("openai.embedding.latency_ms", (time.perf_counter() - started) * 1000)
+            instrument.count("openai.embedding.requests")
+            instrument.count("openai.embedding.texts", len(batch))
+            instrument.count("openai.embedding.tokens_sent", batch_tokens)
+            token_bucket.speed_up()
+            request_bucket.speed_up()
+            for i, embedding in zip(batch, embeddings):
+                results[i] = embedding
+            return batch
+
+    # Batch the rows still to embed, mapping batch positions back to row positions
+    batches = [[todo[j] for j in batch]
+               for batch in make_batches([n_tokens[i] for i in todo], max_batch_tokens, max_batch_size)]
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            batch = future.result()
+            # Store each batch as it completes so an interrupted run keeps what it already paid for
+            if cache is not None:
+                cache.put_many([(keys[i], results[i]) for i in batch])
+            done += len(batch)
+            print(f"Embedded {done}/{len(todo)} chunks")
+
+    return results
@@ -0,0 +1,101 @@
+# Purpose: Persistent, content-addressed cache of chunk embeddings so re-ingesting a topic only
+# embeds the chunks that changed
+import hashlib
+import sqlite3
+import sys
+from array import array
+
+CACHE_PATH = "processed/embeddings_cache.sqlite"
+
+# Stay under SQLite's limit on the number of bound variables per statement
+LOOKUP_BATCH = 500
+
+
+def cache_key(text, model):
+    """
+    Hash of the model name and the chunk text
+    """
+    return hashlib.sha256(f"{model}\0{text}".encode("UTF-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite-backed map from cache_key(text, model) to a float32 embedding. Each topic records the keys
+    it references so entries no topic uses any more can be compacted away.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS topic_refs (topic TEXT NOT NULL, key TEXT NOT NULL, "
+                          "PRIMARY KEY (topic, key))")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        """
+        Look up many keys at once and return a dict of the keys found to their embeddings
+        """
+        keys = list(set(keys))
+        found = {}
+        for start in range(0, len(keys), LOOKUP_BATCH):
+            batch = keys[start:start + LOOKUP_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.conn.execute(f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})", batch)
+            for key, blob in rows:
+                found[key] = array('f', blob).tolist()
+
+        return found
+
+    def put_many(self, items):
+        """
+        Store (key, embedding) pairs
+        """
+        self.conn.executemany("INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                              [(key, array('f', embedding).tobytes()) for key, embedding in items])
+        self.conn.commit()
+
+    def set_topic_refs(self, topic, keys):
+        """
+        Replace the set of keys referenced by a topic
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM topic_refs WHERE topic = ?", (topic,))
+            self.conn.executemany("INSERT OR IGNORE INTO topic_refs (topic, key) VALUES (?, ?)",
+                                  [(topic, key) for key in set(keys)])
+
+    def drop_topic(self, topic):
+        with self.conn:
+            self.conn.execute("DELETE FROM topic_refs WHERE topic = ?", (topic,))
+
+    def compact(self):
+        """
+        Evict the embeddings no topic references any more, reclaim the space and return the count evicted
+        """
+        with self.conn:
+            cursor = self.conn.execute("DELETE FROM embeddings WHERE key NOT IN (SELECT key FROM topic_refs)")
+        self.conn.execute("VACUUM")
+        return cursor.rowcount
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)"
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["compact"] and (len(sys.argv) != 3 or sys.argv[1] != "drop"):
+        print("Usage: python embedding_cache.py compact | drop <topic>")
+        sys.exit(1)
+
+    cache = EmbeddingCache()
+    if sys.argv[1] == "drop":
+        cache.drop_topic(sys.argv[2])
+    print(f"Evicted {cache.compact()} unreferenced embeddings from {cache.path}")
+    cache.close()
@@ -0,0 +1,151 @@
+# Purpose: Deterministic in-process stand-in for the OpenAI embedding and chat endpoints, with
+# configurable latency and rate limits, so ingest and retrieval can be measured without API calls.
+# Chat completions can be streamed, one word per chunk.
+import hashlib
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import openai
+from openai.openai_object import OpenAIObject
+
+EMBEDDING_DIM = 1536
+
+
+def fake_embedding(text, dim=EMBEDDING_DIM):
+    """
+    Unit-length vector derived from the text alone, so the same text always gets the same embedding
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode("UTF-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+class RateWindow:
+    """
+    Sliding one-minute window of requests and tokens, over either limit raises RateLimitError
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.calls = deque()
+        self.tokens = 0
+        self.lock = threading.Lock()
+
+    def admit(self, tokens):
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0][0] >= 60:
+                self.tokens -= self.calls.popleft()[1]
+
+            if (self.requests_per_minute is not None and len(self.calls) + 1 > self.requests_per_minute) or \
+                    (self.tokens_per_minute is not None and self.tokens + tokens > self.tokens_per_minute):
+                raise openai.error.RateLimitError("Rate limit reached (fake backend)")
+
+            self.calls.append((now, tokens))
+            self.tokens += tokens
+
+
+class FakeOpenAI:
+    """
+    Replaces openai.Embedding.create and openai.ChatCompletion.create while installed, as a context
+    manager. Each call sleeps latency seconds plus per_item_latency per input, and counts its requests.
+    A streamed chat completion sleeps chat_latency before its first chunk and chat_token_latency
+    before each of the others.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, embed_latency=0.0, embed_item_latency=0.0, chat_latency=0.0,
+                 chat_token_latency=0.0, requests_per_minute=None, tokens_per_minute=None):
+        self.dim = dim
+        self.embed_latency = embed_latency
+        self.embed_item_latency = embed_item_latency
+        self.chat_latency = chat_latency
+        self.chat_token_latency = chat_token_latency
+        self.window = RateWindow(requests_per_minute, tokens_per_minute)
+        self.embed_requests = 0
+        self.chat_requests = 0
+        self.rate_limited = 0
+        self.chunks_sent = 0
+        self.streams_closed = 0
+        self.saved = None
+
+    def _admit(self, tokens):
+        try:
+            self.window.admit(tokens)
+        except openai.error.RateLimitError:
+            self.rate_limited += 1
+            raise
+
+    def embedding_create(self, input, engine=None, model=None, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        tokens = sum(estimate_tokens(text) for text in texts)
+        self._admit(tokens)
+        self.embed_requests += 1
+        time.sleep(self.embed_latency + self.embed_item_latency * len(texts))
+        return OpenAIObject.construct_from({
+            'object': 'list',
+            'model': engine or model,
+            'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(text, self.dim).tolist()}
+                     for i, text in enumerate(texts)],
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        })
+
+    def chat_completion_create(self, model=None, messages=(), max_tokens=16, n=1, stream=False, **kwargs):
+        prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+        self._admit(prompt_tokens + max_tokens)
+        self.chat_requests += 1
+
+        # Echo the start of the prompt, so answers are deterministic and depend on the context
+        words = messages[-1]['content'].split()[:max_tokens] if messages else []
+        if stream:
+            return self._chat_chunks(model, words)
+
+        time.sleep(self.chat_latency)
+        content = " ".join(words)
+        completion_tokens = min(max_tokens, estimate_tokens(content))
+        return OpenAIObject.construct_from({
+            'object': 'chat.completion',
+            'model': model,
+            'choices': [{'index': i, 'message': {'role': 'assistant', 'content': content},
+                         'finish_reason': 'stop'} for i in range(n)],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        })
+
+    def _chat_chunks(self, model, words):
+        def chunk(delta, finish_reason=None):
+            return OpenAIObject.construct_from({
+                'object': 'chat.completion.chunk',
+                'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            })
+
+        # Like the API: the role first, then the content a piece at a time, then an empty delta
+        try:
+            time.sleep(self.chat_latency)
+            yield chunk({'role': 'assistant'})
+            for i, word in enumerate(words):
+                if i:
+                    time.sleep(self.chat_token_latency)
+                self.chunks_sent += 1
+                yield chunk({'content': word if i == 0 else " " + word})
+            yield chunk({}, 'stop')
+        except GeneratorExit:
+            self.streams_closed += 1
+            raise
+
+    def __enter__(self):
+        self.saved = openai.Embedding.__dict__['create'], openai.ChatCompletion.__dict__['create']
+        openai.Embedding.create = staticmethod(self.embedding_create)
+        openai.ChatCompletion.create = staticmethod(self.chat_completion_create)
+        return self
+
+    def __exit__(self, *exc):
+        openai.Embedding.create, openai.ChatCompletion.create = self.saved
+        self.saved = None
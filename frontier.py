@@ -0,0 +1,278 @@
+# Purpose: Crawl frontier with bounded memory. URLs are canonicalized before they are queued, the
+# queue and the set of URLs seen are the SQLite frontier of crawl_state.py on disk with a Bloom
+# filter in front, and URLs are handed out breadth first or sitemap first within depth and page budgets.
+import gzip
+import hashlib
+import io
+import math
+import re
+import xml.etree.ElementTree as ElementTree
+from functools import lru_cache
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
+# Orders in which the frontier hands out URLs: by depth, or the sitemap's URLs first by their
+# <priority> and then the discovered ones by depth
+BFS = "bfs"
+SITEMAP = "sitemap"
+ORDERS = (BFS, SITEMAP)
+
+# URLs the Bloom filter is sized for and its false positive rate at that size. A false positive only
+# costs a lookup in the SQLite frontier, so the filter never makes the crawl miss a page.
+BLOOM_CAPACITY = 10_000_000
+BLOOM_ERROR_RATE = 0.001
+
+# Links canonicalized recently that are remembered, the navigation of a site repeats on every page
+CANONICAL_CACHE = 65536
+
+# Sitemap entries queued at a time
+SITEMAP_BATCH = 256
+
+# Sitemap files followed through sitemap indexes at most
+MAX_SITEMAPS = 1000
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Query parameters that only track where a visitor came from
+TRACKING_PARAMS = re.compile(r"^(utm_\w+|gclid|fbclid|mc_cid|mc_eid|_ga)$")
+
+# Characters that never need percent-encoding (RFC 3986 unreserved)
+_UNRESERVED = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~")
+_PERCENT = re.compile(r"%([0-9A-Fa-f]{2})")
+
+
+def _normalize_escapes(text):
+    # Decode escaped unreserved characters and upper-case the other escapes
+    def replace(match):
+        char = chr(int(match.group(1), 16))
+        return char if char in _UNRESERVED else "%" + match.group(1).upper()
+
+    return _PERCENT.sub(replace, text)
+
+
+def _remove_dot_segments(path):
+    segments = []
+    for segment in path.split("/"):
+        if segment == "..":
+            if len(segments) > 1:
+                segments.pop()
+        elif segment != ".":
+            segments.append(segment)
+    if path.endswith(("/.", "/..")):
+        segments.append("")
+    return "/".join(segments)
+
+
+@lru_cache(maxsize=CANONICAL_CACHE)
+def canonical_url(url):
+    """
+    Canonical form of an http(s) URL, or None for anything else: lower-case scheme and host, no
+    default port, user info or fragment, no dot segments, normalized percent-escapes, query
+    parameters sorted without tracking ones, and no trailing slash (the crawler's file naming)
+    """
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return None
+
+    host = parts.hostname.rstrip(".")
+    if ":" in host:
+        host = f"[{host}]"
+    netloc = host if port is None or port == DEFAULT_PORTS[scheme] else f"{host}:{port}"
+
+    path = _remove_dot_segments(_normalize_escapes(parts.path))
+    if path.endswith("/"):
+        path = path[:-1]
+    query = urlencode(sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                             if not TRACKING_PARAMS.match(key)))
+
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+class BloomFilter:
+    """
+    Fixed-size set membership test with false positives but no false negatives
+    """
+
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        self.n_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: the k positions are h1 + i * h2 of one 128-bit digest
+        digest = hashlib.blake2b(key.encode("UTF-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+
+def parse_sitemap(content):
+    """
+    Return the (page URLs with their priority, child sitemap URLs) of a sitemap or sitemap index,
+    gzipped or not
+    """
+    if content[:2] == b"\x1f\x8b":
+        content = gzip.decompress(content)
+
+    pages = []
+    sitemaps = []
+    loc = None
+    priority = 0.5
+    for _, element in ElementTree.iterparse(io.BytesIO(content)):
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "loc":
+            loc = (element.text or "").strip()
+        elif tag == "priority":
+            try:
+                priority = float(element.text)
+            except (TypeError, ValueError):
+                pass
+        elif tag in ("url", "sitemap"):
+            if loc:
+                (pages if tag == "url" else sitemaps).append((loc, priority) if tag == "url" else loc)
+            loc = None
+            priority = 0.5
+            # Elements already handled are dropped so large sitemaps parse in bounded memory
+            element.clear()
+    return pages, sitemaps
+
+
+def sitemap_urls(session, url, timeout=30):
+    """
+    Yield the (page URL, priority) entries of the sitemaps of a site: the ones robots.txt lists, or
+    /sitemap.xml, following sitemap indexes
+    """
+    root = urlunsplit(urlsplit(url)[:2] + ("/", "", ""))
+    queue = []
+    try:
+        response = session.get(urljoin(root, "robots.txt"), timeout=timeout)
+        if response.ok:
+            queue = [line.split(":", 1)[1].strip() for line in response.text.splitlines()
+                     if line.lower().startswith("sitemap:")]
+    except Exception as e:
+        print(f"No robots.txt for {root}: {e}")
+    queue = queue or [urljoin(root, "sitemap.xml")]
+
+    fetched = set()
+    while queue and len(fetched) < MAX_SITEMAPS:
+        sitemap = queue.pop(0)
+        if sitemap in fetched:
+            continue
+        fetched.add(sitemap)
+        try:
+            response = session.get(sitemap, timeout=timeout)
+            response.raise_for_status()
+            pages, children = parse_sitemap(response.content)
+        except Exception as e:
+            print(f"Skipping sitemap {sitemap}: {e}")
+            continue
+        queue.extend(children)
+        yield from pages
+
+
+class Frontier:
+    """
+    The URLs of a crawl still to fetch, kept in the SQLite frontier of a CrawlState. Only URLs on the
+    crawled host within max_depth links of the start are queued, and no more than max_pages are handed
+    out; truncated tells whether that budget cut the crawl short.
+    """
+
+    def __init__(self, state, host, max_depth=None, max_pages=None, order=BFS, bloom_capacity=BLOOM_CAPACITY):
+        if order not in ORDERS:
+            raise ValueError(f"Unknown crawl order {order}, expected one of {', '.join(ORDERS)}.")
+        self.state = state
+        self.host = host
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.order = order
+        self.seen = BloomFilter(bloom_capacity)
+        self.dispatched = 0
+        self.truncated = False
+
+    def start(self, url):
+        """
+        Resume the crawl in progress, or start a new one from url. Returns whether it resumed.
+        """
+        resumed = self.state.start(url)
+        if resumed:
+            for queued in self.state.frontier_urls():
+                self.seen.add(queued)
+            self.dispatched = self.state.frontier_done()
+        else:
+            self.seen.add(url)
+        return resumed
+
+    def _new(self, urls):
+        # The Bloom filter answers for most URLs, the ones it may have seen are checked on disk
+        maybe_seen = [url for url in urls if url in self.seen]
+        known = self.state.queued(maybe_seen) if maybe_seen else set()
+        return [url for url in urls if url not in known]
+
+    def add(self, links, depth, ranks=None):
+        """
+        Queue the links found at depth (the start page is depth 0) that were never queued before.
+        ranks overrides the breadth-first order of each link.
+        """
+        if self.max_depth is not None and depth > self.max_depth:
+            return 0
+
+        canonical = {}
+        for i, link in enumerate(links):
+            url = canonical_url(link)
+            if url is not None and url.split("/", 3)[2] == self.host:
+                canonical.setdefault(url, depth if ranks is None else ranks[i])
+
+        new = self._new(list(canonical))
+        for url in new:
+            self.seen.add(url)
+        self.state.enqueue([(url, depth, canonical[url]) for url in new])
+        return len(new)
+
+    def add_sitemap(self, entries):
+        """
+        Queue the (URL, priority) entries of the site's sitemaps as depth 0 pages. In sitemap order
+        they come before every discovered page, highest priority first.
+        """
+        added = 0
+        batch = []
+        for url, priority in entries:
+            batch.append((url, -priority if self.order == SITEMAP else 0))
+            if len(batch) >= SITEMAP_BATCH:
+                added += self.add([url for url, _ in batch], 0, [rank for _, rank in batch])
+                batch.clear()
+        if batch:
+            added += self.add([url for url, _ in batch], 0, [rank for _, rank in batch])
+        return added
+
+    def next(self, n):
+        """
+        Up to n (URL, depth) pairs to fetch next, marked as in flight, within the page budget
+        """
+        if self.max_pages is not None:
+            if n > self.max_pages - self.dispatched:
+                n = self.max_pages - self.dispatched
+                self.truncated = self.truncated or self.state.frontier_pending() > n
+        if n <= 0:
+            return []
+        urls = self.state.lease(n)
+        self.dispatched += len(urls)
+        return urls
@@ -0,0 +1,132 @@
+# Purpose: Single-pass extraction of the visible text and the same-site links of an HTML page. One
+# regex scan over the tags replaces BeautifulSoup's get_text() plus a second parser for the
+# hyperlinks, and leaves out scripts, styles and navigation.
+import html
+import re
+from urllib.parse import urldefrag, urljoin, urlparse
+
+from frontier import DEFAULT_PORTS
+
+# Elements whose content is never visible text
+SKIP_TAGS = frozenset(["script", "style", "noscript", "template", "svg", "canvas", "iframe", "nav"])
+
+# Elements whose content is raw text that may contain "<", it runs until the matching end tag
+RAW_TEXT_TAGS = frozenset(["script", "style", "textarea", "title"])
+
+# Elements that start a new line of text
+BLOCK_TAGS = frozenset(["address", "article", "aside", "blockquote", "br", "dd", "details", "div", "dl", "dt",
+                        "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header",
+                        "hr", "li", "main", "ol", "p", "pre", "section", "summary", "table", "td", "th", "title",
+                        "tr", "ul"])
+
+# Link schemes that never lead to a page
+SKIP_SCHEMES = ("mailto:", "javascript:", "tel:", "data:")
+
+# A start or end tag (quoted attribute values may contain ">"), a comment, a doctype or a processing
+# instruction. A "<" that starts none of them is text.
+_TOKEN = re.compile(r"""<(?:(/?)([a-zA-Z][^\s/>]*)((?:"[^"]*"|'[^']*'|[^'">])*)>|!--.*?-->|![^>]*>|\?[^>]*>)""",
+                    re.S)
+_HREF = re.compile(r"""(?:^|\s)href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.I)
+_RAW_TEXT_END = {tag: re.compile(rf"</{tag}\b[^>]*>", re.I) for tag in RAW_TEXT_TAGS}
+_BLANK_LINES = re.compile(r"\n\s*\n\s*(?:\n\s*)+")
+_TRAILING_SPACE = re.compile(r"[ \t\r\f\v]+\n")
+
+
+def _href(attrs):
+    match = _HREF.search(attrs)
+    if match is None:
+        return None
+    return html.unescape(next(value for value in match.groups() if value is not None))
+
+
+def _origin(parsed):
+    # Host and any port other than the scheme's default, as the frontier compares them: H.IO, h.io:443
+    # and http://h.io are the same site, h.io:8080 is not
+    try:
+        port = parsed.port
+    except ValueError:
+        return None
+    return (parsed.hostname or "").rstrip("."), None if port == DEFAULT_PORTS.get(parsed.scheme) else port
+
+
+def site_links(hrefs, url, base=None):
+    """
+    Absolute URLs of the hrefs found on the page at url (resolved against base when the page has a
+    <base href>) that stay on its host, without fragments or a trailing slash, in order of first appearance
+    """
+    origin = _origin(urlparse(url))
+    base = base or url
+    links = {}
+    for href in hrefs:
+        href = href.strip()
+        if not href or href.startswith("#") or href.lower().startswith(SKIP_SCHEMES):
+            continue
+        link = urldefrag(urljoin(base, href))[0]
+        parsed = urlparse(link)
+        if parsed.scheme not in DEFAULT_PORTS or _origin(parsed) != origin:
+            continue
+        links.setdefault(link[:-1] if link.endswith("/") else link, None)
+    return list(links)
+
+
+def extract(page, url):
+    """
+    Return the visible text of an HTML page and the links to other pages of the same host. Anchors in
+    skipped elements such as <nav> are followed all the same.
+    """
+    parts = []
+    hrefs = []
+    base = None
+    # Skipped elements currently open, innermost last
+    skipping = []
+
+    pos = 0
+    while True:
+        match = _TOKEN.search(page, pos)
+        if match is None:
+            if not skipping:
+                parts.append(page[pos:])
+            break
+        if not skipping and match.start() > pos:
+            parts.append(page[pos:match.start()])
+        pos = match.end()
+
+        closing, name, attrs = match.groups()
+        if name is None:
+            # Comment, doctype or processing instruction
+            continue
+        tag = name.lower()
+
+        if closing:
+            if skipping:
+                if tag in skipping:
+                    # Close the innermost open element of that name and any left unclosed inside it
+                    while skipping.pop() != tag:
+                        pass
+                elif tag in ("body", "html"):
+                    skipping.clear()
+            elif tag in BLOCK_TAGS:
+                parts.append("\n")
+            continue
+
+        if tag == "a" or tag == "base":
+            href = _href(attrs)
+            if href is not None:
+                if tag == "a":
+                    hrefs.append(href)
+                elif base is None:
+                    base = href
+
+        self_closing = attrs.endswith("/")
+        if tag in RAW_TEXT_TAGS and not self_closing:
+            end = _RAW_TEXT_END[tag].search(page, pos)
+            if not skipping and tag not in SKIP_TAGS:
+                parts.append("\n" + page[pos:end.start() if end else len(page)] + "\n")
+            pos = end.end() if end else len(page)
+        elif tag in SKIP_TAGS and not self_closing:
+            skipping.append(tag)
+        elif tag in BLOCK_TAGS and not skipping:
+            parts.append("\n")
+
+    text = _TRAILING_SPACE.sub("\n", html.unescape("".join(parts)))
+    return _BLANK_LINES.sub("\n\n", text).strip(), site_links(hrefs, url, urljoin(url, base) if base else None)
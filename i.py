@@ -1,8 +1,11 @@
-import ast
-import numpy as np
-import openai
-import pandas as pd
-from openai.embeddings_utils import distances_from_embeddings
+import os
+import time
+
+import instrument
+from answer_cache import LRUCache, ResponseCache, normalize_question
+
+# openai, numpy and pandas take seconds to import, so the modules using them are imported in the
+# functions that need them and importing this module stays cheap
 
 GPT_3_5_TOTAL_TOKENS = 4096
 
@@ -12,7 +15,7 @@ GPT_3_5_TURBO = "gpt-3.5-turbo"
 GPT_4 = "gpt-4"
 
 # This file is meant for interactive mode, so we don't need to pass in a filename
-# call load_data() to load the data from a file
+# call load_data() to load the data from a file and pass the result to answer_question()
 g_full_path = None
 
 # Total for GPT-3.5-turbo: 4096
@@ -23,44 +26,64 @@ MAX_TOKENS = 2000
 # For future use
 size = "ada"
 
+# Question embeddings are cached in memory for an hour, answers on disk when temperature is 0 or
+# use_cache is set
+QUESTION_CACHE_SIZE = 1024
+QUESTION_CACHE_TTL = 3600
+RESPONSE_CACHE_SIZE = 10000
 
-def create_context(question, data_frame, max_len=1800):
-    """
-    Create a context for a question by finding the most similar context from the dataframe
-    """
+question_embeddings = LRUCache(QUESTION_CACHE_SIZE, QUESTION_CACHE_TTL)
+response_cache = None
+
+
+def get_response_cache():
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache(max_entries=RESPONSE_CACHE_SIZE)
+    return response_cache
 
-    # Get the embeddings for the question
-    q_embeddings = openai.Embedding.create(input=question, engine='text-embedding-ada-002')['data'][0]['embedding']
 
-    # Get the distances from the embeddings
-    data_frame['distances'] = distances_from_embeddings(q_embeddings, data_frame['embeddings'].values,
-                                                        distance_metric='cosine')
+def cache_stats():
+    print(f"Question embeddings: {question_embeddings.stats()}")
+    if response_cache is not None:
+        print(f"Responses: {response_cache.stats()}")
 
-    returns = []
-    cur_len = 0
 
-    # Sort by distance and add the text to the context until the context is too long
-    for i, row in data_frame.sort_values('distances', ascending=True).iterrows():
+def create_context(question, data_frame, max_len=1800, mode=None):
+    """
+    Create a context for a question by finding the most similar context from the dataframe. The mode
+    is one of retrieval.MODES, hybrid by default when the topic has a BM25 index. The lexical mode
+    makes no API request.
+    """
 
-        # Add the length of the text to the current length
-        cur_len += row['n_tokens'] + 4
+    from retrieval import LEXICAL, as_retriever, embed_question
 
-        # If the context is too long, break
-        if cur_len > max_len:
-            break
+    retriever = as_retriever(data_frame)
+    mode = retriever.mode_for(mode, question)
 
-        # Else add it to the text that is being returned
-        returns.append(row["text"])
+    # Get the embeddings for the question, asking the API only for questions not seen recently
+    q_embeddings = None
+    key = normalize_question(question)
+    if mode != LEXICAL:
+        q_embeddings = question_embeddings.get(key)
+        if q_embeddings is None:
+            instrument.count("qa.question_cache.misses")
+            started = time.perf_counter()
+            q_embeddings = embed_question(key)
+            instrument.observe("openai.embedding.latency_ms", (time.perf_counter() - started) * 1000)
+            question_embeddings.put(key, q_embeddings)
+        else:
+            instrument.count("qa.question_cache.hits")
 
-    # Return the context
-    return "\n\n###\n\n".join(returns)
+    # Add the most similar texts to the context until the context is too long
+    return retriever.context(q_embeddings, max_len=max_len, question=key, mode=mode)
 
 
-def answer_question(data_frame, model=GPT_4,
-                    question="Am I allowed to publish model outputs to Twitter, without a human review?",
-                    max_len_in=MAX_LEN, max_tokens_in=MAX_TOKENS, temperature=0.8, debug=False, stop_sequence=None):
+def _prepare_answer(data_frame, model, question, max_len_in, max_tokens_in, temperature, debug, stop_sequence,
+                    use_cache, mode):
     """
-    Answer a question based on the most similar context from the dataframe texts
+    Check the limits and build the context of an answer. Returns the chat messages, the completion
+    token limit and the response cache key, None when the answer is not cached.
     """
     token_limit = GPT_4_TOTAL_TOKENS if model == GPT_4 else GPT_3_5_TOTAL_TOKENS
 
@@ -84,43 +107,177 @@ def answer_question(data_frame, model=GPT_4,
         f"max_tokens_in is {percentage_max_tokens:.2f}% ({max_tokens_in}) "
         f"of the total {sum_tokens:.0f}.")
 
-    context = create_context(question, data_frame, max_len=max_len_in)
+    with instrument.stage("qa.context"):
+        context = create_context(question, data_frame, max_len=max_len_in, mode=mode)
     # If debug, print the raw model response
     if debug:
         print("Context:\n" + context)
         print("\n\n")
 
-    try:
-        # Create a list of messages
-        messages = [
-            {"role": "system", "content": "You are an AI that answers questions based on the provided context."},
-            {"role": "system", "content": "Let's think step by step."},
-            {"role": "system", "content": "Respond as an expert in great technical detail including code snippets"},
-            {"role": "user", "content": f"Context: {context}\n\n---\n\nQuestion: {question}\nAnswer:"}
-        ]
+    # Sampling at a temperature above 0 gives a different answer each time, only cache it if asked to
+    if use_cache is None:
+        use_cache = temperature == 0
+    cache_key = None
+    if use_cache:
+        cache_key = ResponseCache.key(getattr(data_frame, 'version', None), model, question, context,
+                                      max_tokens=max_tokens_in, stop=stop_sequence, temperature=temperature)
+
+    # Create a list of messages
+    messages = [
+        {"role": "system", "content": "You are an AI that answers questions based on the provided context."},
+        {"role": "system", "content": "Let's think step by step."},
+        {"role": "system", "content": "Respond as an expert in great technical detail including code snippets"},
+        {"role": "user", "content": f"Context: {context}\n\n---\n\nQuestion: {question}\nAnswer:"}
+    ]
+
+    return messages, max_tokens_in, cache_key
+
+
+def _cached_answer(cache_key):
+    if cache_key is None:
+        return None
+    cached = get_response_cache().get(cache_key)
+    instrument.count("qa.response_cache.hits" if cached is not None else "qa.response_cache.misses")
+    return cached
+
+
+def stream_answer(data_frame, model=GPT_4,
+                  question="Am I allowed to publish model outputs to Twitter, without a human review?",
+                  max_len_in=MAX_LEN, max_tokens_in=MAX_TOKENS, temperature=0.8, debug=False, stop_sequence=None,
+                  use_cache=None, cancel=None, mode=None):
+    """
+    Answer a question like answer_question(), returning a generator of the pieces of the answer as the
+    chat model streams them. The limits are checked and the context built before this returns, so
+    errors there are raised here. Set the cancel event, or close the generator, to stop the answer.
+    """
+    from streaming import stream_chat
+
+    messages, max_tokens_in, cache_key = _prepare_answer(data_frame, model, question, max_len_in, max_tokens_in,
+                                                         temperature, debug, stop_sequence, use_cache, mode)
+
+    def pieces():
+        cached = _cached_answer(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        answer = []
+        with instrument.stage("qa.chat"):
+            for piece in stream_chat(messages, model, max_tokens_in, stop_sequence, temperature, cancel):
+                answer.append(piece)
+                yield piece
+
+        # A cancelled answer is incomplete and not cached
+        if cache_key is not None and not (cancel is not None and cancel.is_set()):
+            get_response_cache().put(cache_key, "".join(answer).strip())
 
+    return pieces()
+
+
+def answer_question(data_frame, model=GPT_4,
+                    question="Am I allowed to publish model outputs to Twitter, without a human review?",
+                    max_len_in=MAX_LEN, max_tokens_in=MAX_TOKENS, temperature=0.8, debug=False, stop_sequence=None,
+                    use_cache=None, mode=None):
+    """
+    Answer a question based on the most similar context from the dataframe texts. Responses are
+    cached when temperature is 0, or always or never when use_cache is True or False.
+    This waits for the whole answer in one request, whose usage is counted in the run report, see
+    stream_answer() to print it as it arrives.
+    """
+    import openai
+
+    messages, max_tokens_in, cache_key = _prepare_answer(data_frame, model, question, max_len_in, max_tokens_in,
+                                                         temperature, debug, stop_sequence, use_cache, mode)
+    cached = _cached_answer(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
         # Create a chat completion using the messages
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens_in,
-            n=1,
-            stop=stop_sequence,
-            temperature=temperature,
-        )
-
-        return response.choices[0].message['content'].strip()
+        started = time.perf_counter()
+        with instrument.stage("qa.chat"):
+            response = openai.ChatCompletion.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens_in,
+                n=1,
+                stop=stop_sequence,
+                temperature=temperature,
+            )
+        instrument.observe("openai.chat.latency_ms", (time.perf_counter() - started) * 1000)
+        usage = response.get('usage', {})
+        instrument.count("openai.chat.prompt_tokens", usage.get('prompt_tokens', 0))
+        instrument.count("openai.chat.completion_tokens", usage.get('completion_tokens', 0))
+
+        answer = response.choices[0].message['content'].strip()
+        if cache_key is not None:
+            get_response_cache().put(cache_key, answer)
+        return answer
     except Exception as e:
         print(e)
+        instrument.count("openai.chat.errors")
         return ""
 
 
-def load_data(filename):
-    full_path = f'processed/{filename}_embeddings.csv'
-    print("Loading data from ", full_path, "...")
-    df = pd.read_csv(full_path, index_col=0)
+def load_store_retriever(name, nprobe=None, quantized=True):
+    """
+    Build the Retriever of one store, a topic or a shard of one
+    """
+    from ann import load_index
+    from lexical import load_lexical
+    from quantize import load_quantized
+    from retrieval import NPROBE, Retriever
+    from store import convert_csv, csv_path, load_store, store_paths
+
+    matrix_path, _ = store_paths(name)
+
+    # Convert a CSV left by an older ingest run once, later loads use the binary store
+    if not os.path.exists(matrix_path) and os.path.exists(csv_path(name)):
+        convert_csv(name)
+
+    print("Loading data from ", matrix_path, "...")
+    df, matrix = load_store(name)
+
+    # Large topics use their approximate index when ingest built one, small ones are searched exactly
+    index = load_index(name, len(matrix))
+
+    # With a quantized copy (python quantize.py <topic>) the first pass scans it and the float32 matrix
+    # stays on disk except for the re-ranked candidates
+    compact = load_quantized(name, len(matrix)) if quantized else None
+
+    # The BM25 index built by ingest enables the hybrid and lexical retrieval modes
+    bm25 = load_lexical(name, len(matrix))
+
+    # Build the retriever once per loaded topic, it is passed wherever a data_frame is expected.
+    # Its version changes whenever the store is rewritten, which invalidates cached responses.
+    version = f"{name}@{os.stat(matrix_path).st_mtime_ns}"
+    return Retriever(df['text'], df['n_tokens'], matrix, df, index=index, nprobe=nprobe or NPROBE,
+                     version=version, quantized=compact, lexical=bm25)
+
+
+def load_data(filename, nprobe=None, quantized=True, sources=None):
+    """
+    Load a topic, or several separated by commas, to search them as one. The shards of a sharded topic
+    are searched in parallel, sources limits them to the ones of these sources (or shard names).
+    """
+    from retrieval import ShardedRetriever
+    from store import load_shards, store_paths
 
-    # Use the 'text' column for processing
-    df['embeddings'] = df['embeddings'].apply(ast.literal_eval).apply(np.array)
+    names = []
+    for topic in filename.split(","):
+        shards = load_shards(topic)
+        if shards is None:
+            names.append(topic)
+            continue
+        for source, shard in shards.items():
+            if sources and source not in sources and shard not in sources:
+                continue
+            if os.path.exists(store_paths(shard)[0]):
+                names.append(shard)
+            else:
+                print(f"Skipping {shard}, {source} has not been ingested yet")
+    if not names:
+        raise ValueError(f"No store to load for {filename}" + (f" and sources {', '.join(sources)}" if sources else ""))
 
-    return df
+    retrievers = [load_store_retriever(name, nprobe, quantized) for name in names]
+    return retrievers[0] if len(retrievers) == 1 else ShardedRetriever(retrievers, names)
@@ -0,0 +1,290 @@
+# Purpose: Lightweight run instrumentation: per-stage timers, counters and latency histograms
+# collected in one process-wide registry and written out as a JSON run report, with optional
+# cProfile/tracemalloc profiling of chosen stages
+#
+# INSTRUMENT_REPORT=<path>     write the JSON run report there when a run finishes, or when the
+#                              process exits for the ones that do not write it themselves
+# INSTRUMENT_PROFILE=<stages>  comma separated stage names (or "all") to profile, the profiles go
+#                              to processed/profiles/<stage>.prof and their memory peaks to the report
+import atexit
+import cProfile
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+PROFILE_DIR = "processed/profiles/"
+
+# Allocation sites reported per profiled stage
+TRACEMALLOC_TOP = 10
+
+# Values kept per histogram for its percentiles, a uniform sample of all the values observed once
+# there are more, so long-running processes such as the server use bounded memory
+HISTOGRAM_SAMPLE = 4096
+
+
+class Histogram:
+    """
+    Exact count, sum, min and max of the observed values, with a reservoir sample of them for percentiles
+    """
+
+    def __init__(self, size=HISTOGRAM_SAMPLE):
+        self.size = size
+        self.sample = []
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.sample) < self.size:
+            self.sample.append(value)
+        else:
+            slot = random.randrange(self.count)
+            if slot < self.size:
+                self.sample[slot] = value
+
+
+class Metrics:
+    """
+    Thread-safe registry of stage timers, counters, gauges and histograms
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.profiles = {}
+        # Bumped by every change, to tell whether there is anything new to report
+        self.updates = 0
+
+    def add_time(self, stage, seconds, calls=1):
+        with self.lock:
+            self.updates += 1
+            total, count = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, count + calls)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.updates += 1
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.updates += 1
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.updates += 1
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(value)
+
+    def report(self):
+        # numpy is only needed here, importing it lazily keeps the instrumented CLIs quick to start
+        import numpy as np
+
+        with self.lock:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                p50, p90, p99 = np.percentile(np.asarray(histogram.sample, dtype=np.float64), [50, 90, 99])
+                histograms[name] = {'count': histogram.count, 'sum': histogram.sum, 'min': histogram.min,
+                                    'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+                                    'max': histogram.max}
+
+            return {
+                'started': self.started,
+                'wall_seconds': time.time() - self.started,
+                'stages': {stage: {'seconds': total, 'calls': count} for stage, (total, count) in self.stages.items()},
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': histograms,
+                'profiles': dict(self.profiles),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            for values in (self.stages, self.counters, self.gauges, self.histograms, self.profiles):
+                values.clear()
+
+
+metrics = Metrics()
+
+# Whether the current thread is running under one of our profilers, which do not nest
+_profiling = threading.local()
+
+# Peak traced memory so far of each profiled stage that is open, innermost last. tracemalloc has a
+# single peak for the process, so it is folded into the open stages before a nested stage resets it.
+_traced = []
+_traced_lock = threading.Lock()
+
+
+def _fold_peak(peak):
+    # Caller holds _traced_lock
+    for entry in _traced:
+        entry[0] = max(entry[0], peak)
+
+
+def count(name, n=1):
+    metrics.count(name, n)
+
+
+def gauge(name, value):
+    metrics.gauge(name, value)
+
+
+def observe(name, value):
+    metrics.observe(name, value)
+
+
+def profiled_stages():
+    return {name.strip() for name in os.environ.get("INSTRUMENT_PROFILE", "").split(",") if name.strip()}
+
+
+@contextmanager
+def profile(stage):
+    """
+    Run the block under cProfile and tracemalloc if the stage is listed in INSTRUMENT_PROFILE
+    """
+    wanted = profiled_stages()
+    if stage not in wanted and "all" not in wanted:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    entry = [0]
+    with _traced_lock:
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        _fold_peak(tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        _traced.append(entry)
+    snapshot = tracemalloc.take_snapshot()
+    if getattr(_profiling, 'active', False):
+        # An enclosing stage is being profiled already, only memory is traced for this one
+        profiler = None
+    else:
+        try:
+            profiler.enable()
+            _profiling.active = True
+        except ValueError:
+            # Another profiler is active elsewhere in the process
+            profiler = None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _profiling.active = False
+        top = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')[:TRACEMALLOC_TOP]
+        with _traced_lock:
+            # The enclosing stages' peaks include this one's
+            peak = max(entry[0], tracemalloc.get_traced_memory()[1])
+            _traced.remove(entry)
+            _fold_peak(peak)
+            if not tracing and not _traced:
+                tracemalloc.stop()
+
+        path = None
+        if profiler is not None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = f"{PROFILE_DIR}{stage}.prof"
+            profiler.dump_stats(path)
+        with metrics.lock:
+            metrics.profiles[stage] = {'cprofile': path, 'peak_bytes': peak,
+                                       'top_allocations': [str(stat) for stat in top]}
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a block as a stage, profiling it when asked to
+    """
+    start = time.perf_counter()
+    try:
+        with profile(name):
+            yield
+    finally:
+        metrics.add_time(name, time.perf_counter() - start)
+
+
+def timed_iter(name, iterable):
+    """
+    Yield the items of iterable, timing only the work done to produce them as stage name
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            metrics.add_time(name, time.perf_counter() - start, calls=0)
+            return
+        metrics.add_time(name, time.perf_counter() - start)
+        yield item
+
+
+def rate(counter, stage):
+    """
+    Items of a counter per second of a stage, or None before the stage took any time
+    """
+    with metrics.lock:
+        seconds = metrics.stages.get(stage, (0.0, 0))[0]
+        return metrics.counters.get(counter, 0) / seconds if seconds else None
+
+
+# Serializes report writes, answers may finish in several threads at once
+_report_lock = threading.Lock()
+# metrics.updates when the report was last written
+_reported = 0
+
+
+def write_report(path=None, **extra):
+    """
+    Write the JSON run report to path, or to INSTRUMENT_REPORT when it is set, and return it. Returns
+    None without building the report when there is nowhere to write it.
+    """
+    global _reported
+
+    path = path or os.environ.get("INSTRUMENT_REPORT")
+    if not path:
+        return None
+
+    updates = metrics.updates
+    report = metrics.report()
+    report.update(extra)
+    with _report_lock:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                        prefix=os.path.basename(path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="UTF-8") as f:
+                json.dump(report, f, indent=2, default=str)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        _reported = updates
+    return report
+
+
+@atexit.register
+def _write_report_at_exit():
+    # Interactive sessions, qa.py and the server do not write the report themselves, and a CLI may
+    # record more after writing it
+    if metrics.updates != _reported:
+        write_report()
@@ -0,0 +1,227 @@
+# Purpose: BM25 inverted index over a topic's chunk texts, built at ingest time next to the
+# embeddings. Identifiers are split the way code is written (camelCase, PascalCase, snake_case), so
+# a query like L2OutputOracle or derivePayload finds its chunks without an embedding request.
+import argparse
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+from retrieval import top_k
+from store import STORE_DIR, iter_store_batches, store_paths
+
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Chunks tokenized at a time while building
+BUILD_BATCH = 4096
+
+# A query whose postings cover more than this share of the chunks is scored into a dense array,
+# a sparser one only over the chunks it matches
+DENSE_SHARE = 0.05
+
+_IDENTIFIER = re.compile(r"[A-Za-z0-9_]+")
+_PART = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+[0-9]*|[A-Z]+[0-9]*|[0-9]+")
+
+# Words too common in questions to tell chunks apart
+STOPWORDS = frozenset("""a an and are as at be by can do does for from how i if in is it of on or that the this
+to was what when where which who why with you""".split())
+
+
+def lexical_path(topic):
+    return f"{STORE_DIR}{topic}_bm25.npz"
+
+
+def tokenize(text):
+    """
+    Lowercased terms of a text: every identifier, and when it is made of several words, each of
+    them too, so DerivePayload, derive_payload and "derive payload" share the terms derive and payload
+    """
+    terms = []
+    for identifier in _IDENTIFIER.findall(text):
+        lowered = identifier.lower()
+        if identifier == lowered and "_" not in identifier:
+            # Plain lowercase word, the common case
+            if len(lowered) > 1 and lowered not in STOPWORDS:
+                terms.append(lowered)
+            continue
+
+        parts = [part.lower() for chunk in identifier.split("_") for part in _PART.findall(chunk)]
+        if len(lowered) > 1 and lowered not in STOPWORDS:
+            terms.append(lowered)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if len(part) > 1 and part not in STOPWORDS)
+    return terms
+
+
+class BM25Index:
+    """
+    Postings of every term as a slice of (chunk row, term frequency) arrays, in CSR layout:
+    the postings of term t are docs[offsets[t]:offsets[t + 1]]. The vocabulary is stored as one
+    newline separated byte string.
+    """
+
+    def __init__(self, terms, offsets, docs, tfs, doc_len):
+        self.terms = terms
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.avg_len = float(doc_len.mean()) if len(doc_len) else 0.0
+        n = len(doc_len)
+        df = np.diff(offsets)
+        self.idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        # The document length part of the BM25 denominator, per chunk
+        self.norms = (BM25_K1 * (1 - BM25_B + BM25_B * doc_len / (self.avg_len or 1))).astype(np.float32)
+
+    @classmethod
+    def build(cls, texts):
+        """
+        Build from an iterable of chunk texts, in row order
+        """
+        term_ids = {}
+        doc_len = []
+        blocks = []
+        row = 0
+        batch = []
+
+        def flush():
+            nonlocal row
+            ids, rows, counts = [], [], []
+            for text in batch:
+                counts_of = Counter(tokenize(text))
+                doc_len.append(sum(counts_of.values()))
+                for term, count in counts_of.items():
+                    ids.append(term_ids.setdefault(term, len(term_ids)))
+                    rows.append(row)
+                    counts.append(count)
+                row += 1
+            blocks.append((np.asarray(ids, dtype=np.uint32), np.asarray(rows, dtype=np.uint32),
+                           np.minimum(np.asarray(counts, dtype=np.int64), np.iinfo(np.uint16).max)
+                           .astype(np.uint16)))
+            batch.clear()
+
+        for text in texts:
+            batch.append(text)
+            if len(batch) >= BUILD_BATCH:
+                flush()
+        if batch:
+            flush()
+
+        ids = np.concatenate([block[0] for block in blocks] + [np.empty(0, dtype=np.uint32)])
+        rows = np.concatenate([block[1] for block in blocks] + [np.empty(0, dtype=np.uint32)])
+        counts = np.concatenate([block[2] for block in blocks] + [np.empty(0, dtype=np.uint16)])
+
+        # Group the postings by term, each list stays in row order
+        order = np.argsort(ids, kind='stable')
+        offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(ids, minlength=len(term_ids)))
+        return cls(list(term_ids), offsets, rows[order], counts[order], np.asarray(doc_len, dtype=np.uint32))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            terms = data['terms'].tobytes().decode("UTF-8").split("\n") if len(data['offsets']) > 1 else []
+            return cls(terms, data['offsets'], data['docs'], data['tfs'], data['doc_len'])
+
+    def save(self, path):
+        # np.savez appends .npz unless the name already ends with it
+        tmp_path = path[:-len(".npz")] + ".tmp.npz"
+        terms = np.frombuffer("\n".join(self.terms).encode("UTF-8"), dtype=np.uint8)
+        np.savez(tmp_path, terms=terms, offsets=self.offsets, docs=self.docs, tfs=self.tfs, doc_len=self.doc_len)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.docs.nbytes + self.tfs.nbytes + self.doc_len.nbytes + \
+            sum(len(term) + 1 for term in self.terms)
+
+    def search(self, question, k):
+        """
+        Return the row positions and BM25 scores of the k best matching chunks, best first. Only the
+        chunks containing at least one term of the question are scored.
+        """
+        ids = {self.term_ids[term] for term in tokenize(question) if term in self.term_ids}
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        postings = [(term_id, self.offsets[term_id], self.offsets[term_id + 1]) for term_id in ids]
+        dense = sum(stop - start for _, start, stop in postings) > DENSE_SHARE * len(self)
+        scores = np.zeros(len(self), dtype=np.float32) if dense else None
+        rows = []
+        contributions = []
+        for term_id, start, stop in postings:
+            tf = self.tfs[start:stop].astype(np.float32)
+            docs = self.docs[start:stop]
+            contribution = self.idf[term_id] * (BM25_K1 + 1) * tf / (tf + self.norms[docs])
+            if dense:
+                # A posting list holds each chunk once, so the fancy-indexed add is safe
+                scores[docs] += contribution
+            else:
+                rows.append(docs)
+                contributions.append(contribution)
+
+        if dense:
+            top = top_k(scores, min(k, int(np.count_nonzero(scores))))
+            return top.astype(np.int64), scores[top]
+
+        candidates, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions)).astype(np.float32)
+        top = top_k(scores, k)
+        return candidates[top].astype(np.int64), scores[top]
+
+
+def build_lexical(topic):
+    """
+    Build and save the BM25 index of a topic from its stored chunk texts
+    """
+    texts = (text for meta, _ in iter_store_batches(topic, BUILD_BATCH, columns=['text']) for text in meta.text)
+    index = BM25Index.build(texts)
+    path = lexical_path(topic)
+    index.save(path)
+    print(f"Saved BM25 index of {len(index.terms)} terms ({index.nbytes / 2 ** 20:.1f} MiB) to {path}")
+    return index
+
+
+def load_lexical(topic, n_rows):
+    """
+    Load the BM25 index of a topic when there is one that matches the current store
+    """
+    path = lexical_path(topic)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(store_paths(topic)[0]):
+        return None
+
+    index = BM25Index.load(path)
+    if len(index) != n_rows:
+        return None
+
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the BM25 index of a topic or look up identifiers in it")
+    parser.add_argument("topic")
+    parser.add_argument("--query", action="append", help="print the best chunks for a query, repeatable")
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    if not args.query:
+        build_lexical(args.topic)
+    else:
+        from store import load_store
+
+        meta, _ = load_store(args.topic)
+        bm25 = load_lexical(args.topic, len(meta)) or build_lexical(args.topic)
+        for query in args.query:
+            started = time.perf_counter()
+            top, top_scores = bm25.search(query, args.k)
+            print(f"{query}: {(time.perf_counter() - started) * 1000:.2f} ms")
+            for position, score in zip(top, top_scores):
+                print(f"  {score:7.2f}  {meta['text'][position][:100]!r}")
@@ -0,0 +1,70 @@
+# Purpose: Helpers to run the stages of a generator pipeline in their own threads, handing items
+# over through bounded queues so no stage runs far ahead of the next one
+import queue
+import threading
+
+QUEUE_SIZE = 8
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def threaded(iterable, maxsize=QUEUE_SIZE):
+    """
+    Iterate over iterable in a background thread and yield its items. At most maxsize items wait in
+    between, and an exception raised by the stage is raised again in the consumer.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        # Give up when the consumer went away, returns whether the item was handed over
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Failure(e))
+        else:
+            put(_DONE)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+
+
+def batched(iterable, size):
+    """
+    Group items into lists of at most size items
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
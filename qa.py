@@ -1,65 +1,117 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import random
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import numpy as np
-import openai
-import pandas as pd
-from openai.embeddings_utils import distances_from_embeddings
+# openai, numpy and pandas take seconds to import, so the modules using them are imported in the
+# functions that need them: --help and --list start without loading any of them
 
 QA_GPT_MODEL = "gpt-3.5-turbo"
 
-if len(sys.argv) != 2:
-    print("Usage: python qa.py <embeddings_csv_filename>")
-    sys.exit(1)
+# Where ingest saves the topics, see store.store_paths
+TOPICS_DIR = "processed/"
 
-embeddings_csv_filename = sys.argv[1]
-g_full_path = f"processed/{embeddings_csv_filename}"
+# Chat completions kept in flight at the same time in batch mode
+MAX_CONCURRENCY = 8
 
-df = pd.read_csv(g_full_path, index_col=0)
-df[g_full_path] = df[g_full_path].apply(eval).apply(np.array)
 
-print(df.head())
+def list_topics(topics_dir=TOPICS_DIR):
+    """
+    Names of the topics with a store or a shard list, or a CSV left by an older ingest that is
+    converted on first use. The shards of a topic are not listed separately.
+    """
+    from store import SHARD_SEPARATOR
+
+    topics = set()
+    for suffix in ("_embeddings.npy", "_embeddings.csv", "_shards.json"):
+        topics.update(os.path.basename(path)[:-len(suffix)] for path in glob.glob(f"{topics_dir}*{suffix}"))
+    return sorted(topic for topic in topics if SHARD_SEPARATOR not in topic)
+
+
+def load_retriever(topic, sources=None):
+    """
+    Load a topic, or several separated by commas, see i.load_data
+    """
+    from i import load_data
+
+    # Loading reports its progress on stdout, which may be the JSONL output
+    with contextlib.redirect_stdout(sys.stderr):
+        return load_data(topic, sources=sources)
 
 
-def create_context(question, data_frame, max_len=1800):
+def create_context(question, data_frame, max_len=1800, mode=None):
     """
-    Create a context for a question by finding the most similar context from the dataframe
+    Create a context for a question by finding the most similar context from the dataframe, see
+    retrieval.MODES for the modes. The lexical mode makes no API request.
     """
+    from retrieval import LEXICAL, as_retriever, embed_question
+
+    retriever = as_retriever(data_frame)
+    mode = retriever.mode_for(mode, question)
 
     # Get the embeddings for the question
-    q_embeddings = openai.Embedding.create(input=question, engine='text-embedding-ada-002')['data'][0]['embedding']
+    q_embeddings = embed_question(question) if mode != LEXICAL else None
+
+    # Add the most similar texts to the context until the context is too long
+    return retriever.context(q_embeddings, max_len=max_len, question=question, mode=mode)
 
-    # Get the distances from the embeddings
-    data_frame['distances'] = distances_from_embeddings(q_embeddings, data_frame['embeddings'].values,
-                                                        distance_metric='cosine')
 
-    returns = []
-    cur_len = 0
+def messages_for(context, question):
+    return [
+        {"role": "system", "content": "You are an AI that answers questions based on the provided context."},
+        {"role": "user", "content": f"Context: {context}\n\n---\n\nQuestion: {question}\nAnswer:"}
+    ]
 
-    # Sort by distance and add the text to the context until the context is too long
-    for _, row in data_frame.sort_values('distances', ascending=True).iterrows():
 
-        # Add the length of the text to the current length
-        cur_len += row['n_tokens'] + 4
+def chat(context, question, model="gpt-3.5-turbo", max_tokens=150, stop_sequence=None):
+    """
+    Ask the chat model a question about a context and return the raw response
+    """
+    import openai
+
+    # Create a chat completion using the messages
+    return openai.ChatCompletion.create(
+        model=model,
+        messages=messages_for(context, question),
+        max_tokens=max_tokens,
+        n=1,
+        stop=stop_sequence,
+        temperature=0
+    )
+
+
+def stream_answer(data_frame, model="gpt-3.5-turbo",
+                  question="Am I allowed to publish model outputs to Twitter, without a human review?", max_len=1800,
+                  debug=False, max_tokens=150, stop_sequence=None, cancel=None, mode=None):
+    """
+    Answer a question like answer_question(), returning a generator of the pieces of the answer as the
+    chat model streams them. The context is built before this returns. Set the cancel event, or close
+    the generator, to stop the answer.
+    """
+    from streaming import stream_chat
 
-        # If the context is too long, break
-        if cur_len > max_len:
-            break
+    context = create_context(question, data_frame, max_len=max_len, mode=mode)
 
-        # Else add it to the text that is being returned
-        returns.append(row["text"])
+    # If debug, print the raw model response
+    if debug:
+        print("Context:\n" + context)
+        print("\n\n")
 
-    # Return the context
-    return "\n\n###\n\n".join(returns)
+    return stream_chat(messages_for(context, question), model, max_tokens, stop_sequence, cancel=cancel)
 
 
 def answer_question(data_frame, model="gpt-3.5-turbo",
                     question="Am I allowed to publish model outputs to Twitter, without a human review?", max_len=1800,
-                    debug=False, max_tokens=150, stop_sequence=None):
+                    debug=False, max_tokens=150, stop_sequence=None, mode=None):
     """
-    Answer a question based on the most similar context from the dataframe texts
+    Answer a question based on the most similar context from the dataframe texts, in one request
     """
-
-    context = create_context(question, data_frame, max_len=max_len)
+    context = create_context(question, data_frame, max_len=max_len, mode=mode)
 
     # If debug, print the raw model response
     if debug:
@@ -67,30 +119,136 @@ def answer_question(data_frame, model="gpt-3.5-turbo",
         print("\n\n")
 
     try:
-        # Create a list of messages
-        messages = [
-            {"role": "system", "content": "You are an AI that answers questions based on the provided context."},
-            {"role": "user", "content": f"Context: {context}\n\n---\n\nQuestion: {question}\nAnswer:"}
-        ]
-
-        # Create a chat completion using the messages
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            n=1,
-            stop=stop_sequence,
-            temperature=0
-        )
-
+        response = chat(context, question, model, max_tokens, stop_sequence)
         return response.choices[0].message['content'].strip()
     except Exception as e:
         print(e)
         return ""
 
 
-print(answer_question(df, QA_GPT_MODEL, question="What day is it?", debug=False))
-print()
-print(answer_question(df, QA_GPT_MODEL, question="What is op stack?"))
-print()
-print(answer_question(df, QA_GPT_MODEL, question="What is ethereum equivalence?"))
+def print_answer(data_frame, model, question, mode=None):
+    """
+    Print the answer to a question as it is streamed, a newline ends it
+    """
+    try:
+        for piece in stream_answer(data_frame, model, question, mode=mode):
+            print(piece, end="", flush=True)
+    except Exception as e:
+        print(e, end="")
+    print()
+
+
+def read_questions(file):
+    """
+    One question per non-empty line
+    """
+    return [line.strip() for line in file if line.strip()]
+
+
+def answer_questions(retriever, questions, out, model=QA_GPT_MODEL, max_len=1800, max_tokens=150,
+                     concurrency=MAX_CONCURRENCY, max_retries=None, mode=None):
+    """
+    Answer many questions: embed them in batched requests, retrieve all their contexts with one
+    matrix-matrix product per block of questions and run up to `concurrency` chat completions at a
+    time. Writes a JSON line per question to out as soon as it is answered, in completion order.
+    """
+    from embedder import MAX_RETRIES, RETRYABLE_ERRORS
+    from retrieval import LEXICAL, embed_questions
+
+    if not questions:
+        return
+    if max_retries is None:
+        max_retries = MAX_RETRIES
+
+    mode = retriever.mode_for(mode, questions)
+    q_embeddings = None
+    if mode != LEXICAL:
+        # The embedder reports its progress on stdout, which may be the JSONL output
+        with contextlib.redirect_stdout(sys.stderr):
+            q_embeddings = embed_questions(questions)
+    contexts = retriever.contexts(q_embeddings, max_len=max_len, questions=questions, mode=mode)
+
+    def ask(i):
+        started = time.monotonic()
+        for attempt in range(max_retries + 1):
+            try:
+                response = chat(contexts[i], questions[i], model, max_tokens)
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    return {'index': i, 'question': questions[i], 'error': str(e),
+                            'latency_ms': round((time.monotonic() - started) * 1000, 1)}
+                # Exponential backoff with jitter before asking again
+                time.sleep(min(60.0, 2 ** attempt) * (0.5 + random.random()))
+            except Exception as e:
+                return {'index': i, 'question': questions[i], 'error': str(e),
+                        'latency_ms': round((time.monotonic() - started) * 1000, 1)}
+
+        usage = response.get('usage', {})
+        return {'index': i, 'question': questions[i], 'answer': response.choices[0].message['content'].strip(),
+                'latency_ms': round((time.monotonic() - started) * 1000, 1),
+                'prompt_tokens': usage.get('prompt_tokens'), 'completion_tokens': usage.get('completion_tokens'),
+                'total_tokens': usage.get('total_tokens')}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(ask, i) for i in range(len(questions))]
+        for future in as_completed(futures):
+            out.write(json.dumps(future.result()) + "\n")
+            out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer questions about a topic.")
+    parser.add_argument("topic", nargs="?",
+                        help="topic name or comma separated names, <topic>_embeddings.csv is accepted too")
+    parser.add_argument("--source", action="append", metavar="SOURCE",
+                        help="only search the shards of this source of a sharded topic, repeatable")
+    parser.add_argument("--list", action="store_true", help="list the available topics and exit")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="answer the questions in FILE, one per line, or on stdin with -, as JSON lines")
+    parser.add_argument("--output", metavar="FILE", help="write the JSON lines to FILE instead of stdout")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENCY,
+                        help=f"chat completions in flight at a time (default {MAX_CONCURRENCY})")
+    parser.add_argument("--model", default=QA_GPT_MODEL)
+    parser.add_argument("--max-len", type=int, default=1800, help="context tokens per question")
+    parser.add_argument("--max-tokens", type=int, default=150, help="answer tokens per question")
+    parser.add_argument("--mode", choices=("vector", "hybrid", "lexical"),
+                        help="retrieval mode, hybrid when the topic has a BM25 index and vector otherwise")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(list_topics()))
+        return
+    if args.topic is None:
+        parser.error("a topic is required, see --list for the available ones")
+
+    # Also accept the <topic>_embeddings.csv filename used by older versions
+    topic = ",".join(name.removesuffix("_embeddings.csv") for name in args.topic.split(","))
+    retriever = load_retriever(topic, args.source)
+
+    if args.batch is None:
+        # The frame of a sharded topic is assembled from all its shards, the first one is enough for a preview
+        print(getattr(retriever, "shards", [retriever])[0].frame.head())
+        # The answers are printed as they are streamed
+        print_answer(retriever, args.model, "What day is it?", args.mode)
+        print()
+        print_answer(retriever, args.model, "What is op stack?", args.mode)
+        print()
+        print_answer(retriever, args.model, "What is ethereum equivalence?", args.mode)
+        return
+
+    if args.batch == "-":
+        questions = read_questions(sys.stdin)
+    else:
+        with open(args.batch, "r", encoding="UTF-8") as f:
+            questions = read_questions(f)
+
+    with open(args.output, "w", encoding="UTF-8") if args.output else contextlib.nullcontext(sys.stdout) as out:
+        started = time.monotonic()
+        answer_questions(retriever, questions, out, args.model, args.max_len, args.max_tokens, args.concurrency,
+                         mode=args.mode)
+        print(f"Answered {len(questions)} questions in {time.monotonic() - started:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
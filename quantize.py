@@ -0,0 +1,185 @@
+# Purpose: Optional compact copies of a topic's embeddings for the first-pass similarity scan:
+# float16, or int8 scalar quantization with one scale per vector. The best candidates of the scan
+# are re-ranked against the full-precision float32 rows of the memory-mapped store.
+import argparse
+import os
+import time
+
+import numpy as np
+
+from retrieval import RERANK_FACTOR, Retriever, normalize
+from store import STORE_DIR, load_store, store_paths
+
+DTYPES = ("int8", "float16")
+
+# Rows converted back to float32 at a time during a scan. Small blocks stay in the CPU cache, which
+# makes the conversion almost free next to the dot products.
+SCAN_BLOCK = 256
+
+# Rows normalized and quantized at a time when building
+BUILD_BLOCK = 16384
+
+
+def quantized_paths(topic, dtype):
+    """
+    Return the (codes, scales) paths of a quantized copy, int8 codes have one scale per row
+    """
+    return f"{STORE_DIR}{topic}_embeddings.{dtype}.npy", f"{STORE_DIR}{topic}_embeddings.{dtype}.scales.npy"
+
+
+class QuantizedMatrix:
+    """
+    Unit-normalized embeddings stored as float16, or as int8 codes times a per-row float32 scale
+    """
+
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def build(cls, matrix, dtype="int8"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown quantized dtype {dtype}, expected one of {', '.join(DTYPES)}.")
+
+        codes = np.empty(matrix.shape, dtype=np.int8 if dtype == "int8" else np.float16)
+        scales = np.empty(len(matrix), dtype=np.float32) if dtype == "int8" else None
+        for start in range(0, len(matrix), BUILD_BLOCK):
+            block = normalize(matrix[start:start + BUILD_BLOCK])
+            if scales is None:
+                codes[start:start + len(block)] = block
+                continue
+
+            # Symmetric scaling maps the largest component of each row to +-127
+            block_scales = np.abs(block).max(axis=1) / 127
+            block_scales[block_scales == 0] = 1
+            codes[start:start + len(block)] = np.round(block / block_scales[:, None])
+            scales[start:start + len(block)] = block_scales
+
+        return cls(codes, scales)
+
+    @classmethod
+    def load(cls, codes_path, scales_path=None, mmap=True):
+        codes = np.load(codes_path, mmap_mode='r' if mmap else None)
+        scales = np.load(scales_path) if scales_path is not None and os.path.exists(scales_path) else None
+        return cls(codes, scales)
+
+    def save(self, codes_path, scales_path):
+        tmp_codes_path = codes_path[:-len(".npy")] + ".tmp.npy"
+        np.save(tmp_codes_path, self.codes)
+        if self.scales is not None:
+            tmp_scales_path = scales_path[:-len(".npy")] + ".tmp.npy"
+            np.save(tmp_scales_path, self.scales)
+            os.replace(tmp_scales_path, scales_path)
+        os.replace(tmp_codes_path, codes_path)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def scores(self, queries, rows=None):
+        """
+        Approximate dot products of the rows (all of them by default) with a query vector, or with
+        each column of a (dim, n_queries) matrix of queries
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        n = len(self.codes) if rows is None else len(rows)
+        out = np.empty((n,) + queries.shape[1:], dtype=np.float32)
+        buffer = np.empty((SCAN_BLOCK, self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, n, SCAN_BLOCK):
+            stop = min(n, start + SCAN_BLOCK)
+            block_rows = slice(start, stop) if rows is None else rows[start:stop]
+            block = buffer[:stop - start]
+            np.copyto(block, self.codes[block_rows], casting='unsafe')
+            np.dot(block, queries, out=out[start:stop])
+        if self.scales is not None:
+            scales = self.scales if rows is None else self.scales[rows]
+            out *= scales.reshape((-1,) + (1,) * (queries.ndim - 1))
+        return out
+
+
+def build_quantized(topic, dtype="int8"):
+    """
+    Build and save the quantized copy of a topic's embeddings
+    """
+    _, matrix = load_store(topic)
+    quantized = QuantizedMatrix.build(matrix, dtype)
+    codes_path, scales_path = quantized_paths(topic, dtype)
+    quantized.save(codes_path, scales_path)
+    print(f"Saved {dtype} embeddings ({quantized.nbytes / 2 ** 20:.1f} MiB) to {codes_path}")
+    return quantized
+
+
+def refresh_quantized(topic):
+    """
+    Rebuild the quantized copies a topic already has, after its embeddings changed
+    """
+    for dtype in DTYPES:
+        if os.path.exists(quantized_paths(topic, dtype)[0]):
+            build_quantized(topic, dtype)
+
+
+def load_quantized(topic, n_rows, dtype=None):
+    """
+    Load a quantized copy of a topic that matches its current embeddings, preferring int8 when no
+    dtype is given. Returns None if there is none.
+    """
+    matrix_mtime = os.path.getmtime(store_paths(topic)[0])
+    for candidate in ((dtype,) if dtype else DTYPES):
+        codes_path, scales_path = quantized_paths(topic, candidate)
+        if not os.path.exists(codes_path) or os.path.getmtime(codes_path) < matrix_mtime:
+            continue
+        quantized = QuantizedMatrix.load(codes_path, scales_path if candidate == "int8" else None)
+        if len(quantized) == n_rows:
+            return quantized
+    return None
+
+
+def quantization_report(meta, matrix, dtype, k=10, n_queries=200, seed=0):
+    """
+    Print the memory of each representation and recall@k and latency of the quantized scan, with and
+    without re-ranking, against exact search. The queries are perturbed chunks of the topic.
+    """
+    n, dim = matrix.shape
+    print(f"{n} chunks of dimension {dim}")
+    print(f"float64 lists (old load_data)  {n * dim * 8 / 2 ** 20:10.1f} MiB")
+    print(f"float32 matrix                 {n * dim * 4 / 2 ** 20:10.1f} MiB")
+
+    quantized = QuantizedMatrix.build(matrix, dtype)
+    print(f"{dtype} first pass{'':<15}{quantized.nbytes / 2 ** 20:10.1f} MiB "
+          f"({quantized.nbytes / (n * dim * 4):.0%} of float32)")
+
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(n, min(n_queries, n), replace=False)
+    queries = normalize(np.asarray(matrix[rows]) + rng.normal(0, 0.5 / np.sqrt(dim), (len(rows), dim)))
+
+    exact = Retriever(meta['text'], meta['n_tokens'], matrix)
+    start = time.perf_counter()
+    truth = [set(exact.search(q, k)[0]) for q in queries]
+    print(f"exact                  recall@{k} 1.000  {(time.perf_counter() - start) / len(queries) * 1000:8.3f} "
+          f"ms/query")
+
+    for label, rerank in (("quantized only", 1), (f"quantized + re-rank x{RERANK_FACTOR}", RERANK_FACTOR)):
+        approx = Retriever(meta['text'], meta['n_tokens'], matrix, quantized=quantized, rerank=rerank)
+        start = time.perf_counter()
+        found = [set(approx.search(q, k)[0]) for q in queries]
+        elapsed = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(t & f) / len(t) for t, f in zip(truth, found)])
+        print(f"{label:<22} recall@{k} {recall:.3f}  {elapsed:8.3f} ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a quantized copy of a topic's embeddings")
+    parser.add_argument("topic")
+    parser.add_argument("--dtype", choices=DTYPES, default="int8")
+    parser.add_argument("--report", action="store_true", help="report memory and recall instead of building")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.report:
+        quantization_report(*load_store(args.topic), args.dtype, k=args.k, n_queries=args.queries)
+    else:
+        build_quantized(args.topic, args.dtype)
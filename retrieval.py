@@ -0,0 +1,425 @@
+# Purpose: Vectorized top-k retrieval over a topic's embeddings, built once per loaded topic
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from embedder import EMBEDDING_MODEL, embed_texts, openai_embed
+
+# Tokens added per chunk for the "\n\n###\n\n" separator when filling the context
+SEPARATOR_TOKENS = 4
+CONTEXT_SEPARATOR = "\n\n###\n\n"
+
+# Number of IVF lists scanned per query when the Retriever has an approximate index
+NPROBE = 8
+
+# Questions scored at a time by the batched search, bounding the score matrix to this many rows
+QUERY_BLOCK = 64
+
+# Chunks whose embeddings are at least this similar to a chunk already in the context are skipped.
+# When that leaves room once the candidates run out, a second pass fetches this many times more.
+DUPLICATE_SIMILARITY = 0.97
+DUPLICATE_OVERSAMPLE = 2
+
+# With a quantized first pass (see quantize.py), this many times k candidates are re-ranked against
+# the full-precision rows
+RERANK_FACTOR = 4
+
+# Retrieval modes: embeddings only, embeddings fused with BM25 (see lexical.py), or BM25 only, which
+# needs no embedding request. Hybrid is the default when the topic has a BM25 index.
+VECTOR = "vector"
+HYBRID = "hybrid"
+LEXICAL = "lexical"
+MODES = (VECTOR, HYBRID, LEXICAL)
+
+# Reciprocal rank fusion constant, a chunk scores the sum of 1 / (RRF_K + rank) over the rankings
+RRF_K = 60
+
+# Threads searching the shards of a ShardedRetriever, numpy releases the GIL during the scans
+SHARD_WORKERS = os.cpu_count() or 4
+
+
+def normalize(vectors):
+    """
+    Scale float32 vectors to unit length so cosine similarity is a plain dot product
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """
+    Positions of the k highest scores, best first
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    """
+    Merge rankings of row positions, best first, into the k best by reciprocal rank fusion. Ties keep
+    the order of the first ranking.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking.tolist()):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return np.asarray(sorted(scores, key=scores.get, reverse=True)[:k], dtype=np.int64)
+
+
+def embed_question(question, model=EMBEDDING_MODEL):
+    return np.asarray(openai_embed([question], model)[0], dtype=np.float32)
+
+
+def embed_questions(questions, model=EMBEDDING_MODEL):
+    """
+    Embed many questions in as few batched requests as possible and return them as a float32 matrix
+    """
+    return np.asarray(embed_texts(questions, model=model), dtype=np.float32)
+
+
+class Retriever:
+    """
+    Holds a unit-normalized float32 matrix of chunk embeddings with the chunk texts and token costs.
+    Queries never modify any state, so one Retriever can be shared between threads.
+    With an approximate index (see ann.py) only the rows in the nprobe closest lists are scanned.
+    With a quantized copy the first pass scans it instead, and only the rerank * k best candidates
+    are read from the full-precision matrix, which can then stay memory mapped on disk.
+    The version identifies the loaded store, e.g. for cache keys. Near duplicate chunks are left out
+    of the context unless duplicate_similarity is None. With a BM25 index (see lexical.py) the
+    questions themselves can be searched too, see MODES.
+    """
+
+    def __init__(self, texts, n_tokens, matrix, frame=None, index=None, nprobe=NPROBE, version=None,
+                 duplicate_similarity=DUPLICATE_SIMILARITY, quantized=None, rerank=RERANK_FACTOR, lexical=None):
+        self.texts = list(texts)
+        self.lexical = lexical
+        self.version = version
+        self.duplicate_similarity = duplicate_similarity
+        self.quantized = quantized
+        self.rerank = rerank
+        self.n_tokens = np.asarray(n_tokens, dtype=np.int64)
+        self.costs = self.n_tokens + SEPARATOR_TOKENS
+        self.frame = frame
+        self.index = index
+        self.nprobe = nprobe
+
+        # ada-002 embeddings are already unit length, in which case a memory mapped matrix is used as is.
+        # With a quantized copy the matrix is never read as a whole, its candidate rows are normalized
+        # when they are re-ranked.
+        matrix = np.asarray(matrix)
+        if quantized is not None or (matrix.dtype == np.float32 and self._unit_rows(matrix)):
+            self.matrix = matrix
+        else:
+            self.matrix = normalize(matrix)
+
+        self.min_cost = int(self.costs.min()) if len(self.costs) else SEPARATOR_TOKENS
+
+    @staticmethod
+    def _unit_rows(matrix):
+        return not len(matrix) or np.allclose(np.linalg.norm(matrix, axis=1), 1, atol=1e-3)
+
+    @classmethod
+    def from_frame(cls, data_frame, matrix=None):
+        """
+        Build a Retriever from a DataFrame with text and n_tokens columns. Without a matrix the
+        embeddings column is stacked into one.
+        """
+        if matrix is None:
+            matrix = np.vstack(data_frame['embeddings'].values).astype(np.float32)
+        frame = data_frame.drop(columns=['embeddings'], errors='ignore')
+        return cls(data_frame['text'], data_frame['n_tokens'], matrix, frame)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def search(self, q_embedding, k, nprobe=None):
+        """
+        Return the row positions and cosine similarities of the k most similar chunks, best first
+        """
+        q_embedding = normalize(q_embedding)
+        rows = None
+        if self.index is not None:
+            rows = self.index.candidates(q_embedding, nprobe or self.nprobe)
+
+        if self.quantized is not None:
+            top = top_k(self.quantized.scores(q_embedding, rows), k * self.rerank)
+            return self._rerank(q_embedding, top if rows is None else rows[top], k)
+
+        if rows is not None:
+            scores = np.asarray(self.matrix[rows]) @ q_embedding
+        else:
+            scores = self.matrix @ q_embedding
+
+        top = top_k(scores, k)
+        if rows is not None:
+            return rows[top], scores[top]
+        return top, scores[top]
+
+    def _rerank(self, q_embedding, candidates, k):
+        # Exact similarities of the candidates, read in row order from the full-precision matrix
+        candidates = np.sort(candidates)
+        scores = normalize(self.matrix[candidates]) @ q_embedding
+        top = top_k(scores, k)
+        return candidates[top], scores[top]
+
+    def search_many(self, q_embeddings, k, nprobe=None):
+        """
+        search() for a matrix of questions, one row each. Without an index the questions are scored
+        QUERY_BLOCK at a time with a single matrix-matrix product per block.
+        """
+        q_embeddings = normalize(np.atleast_2d(q_embeddings))
+        if self.index is not None:
+            return [self.search(q, k, nprobe) for q in q_embeddings]
+
+        if self.quantized is not None:
+            results = []
+            for start in range(0, len(q_embeddings), QUERY_BLOCK):
+                block = q_embeddings[start:start + QUERY_BLOCK]
+                scores = self.quantized.scores(block.T).T
+                results.extend(self._rerank(q, top_k(q_scores, k * self.rerank), k)
+                               for q, q_scores in zip(block, scores))
+            return results
+
+        k = min(k, len(self.matrix))
+        results = []
+        for start in range(0, len(q_embeddings), QUERY_BLOCK):
+            scores = q_embeddings[start:start + QUERY_BLOCK] @ self.matrix.T
+            if k <= 0:
+                results.extend((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in scores)
+                continue
+
+            if k < scores.shape[1]:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            results.extend(zip(top, top_scores))
+        return results
+
+    @property
+    def has_lexical(self):
+        return self.lexical is not None
+
+    def search_lexical(self, question, k):
+        """
+        Return the row positions and BM25 scores of the k chunks best matching the question's terms
+        """
+        return self.lexical.search(question, k)
+
+    def mode_for(self, mode, question=None):
+        """
+        The retrieval mode to use: hybrid when a question is given and there is a BM25 index, else vector
+        """
+        if mode is None:
+            return HYBRID if question is not None and self.has_lexical else VECTOR
+        if mode not in MODES:
+            raise ValueError(f"Unknown retrieval mode {mode}, expected one of {', '.join(MODES)}.")
+        if mode != VECTOR and not self.has_lexical:
+            raise ValueError(f"{mode} retrieval needs a BM25 index, build it with python lexical.py <topic>.")
+        return mode
+
+    def _candidates(self, max_len):
+        # Every chunk costs at least min_cost, so no more than this many can fit in the budget
+        return max_len // self.min_cost + 1
+
+    def _fill(self, top, max_len):
+        """
+        Keep the candidates, best first, whose running token total stays within the budget, leaving out
+        near duplicates of a better one already kept. Each candidate's row is read and normalized only
+        when it is reached and compared with the kept rows alone. Also returns whether near duplicates
+        were skipped while the budget still had room, when more candidates could fill it.
+        """
+        if self.duplicate_similarity is None or len(top) < 2:
+            total = np.cumsum(self.costs[top])
+            return top[:np.searchsorted(total, max_len, side='right')], False
+
+        keep = []
+        kept = None
+        total = 0
+        skipped = False
+        for i, position in enumerate(top):
+            cost = self.costs[position]
+            if total + cost > max_len:
+                return top[keep], False
+            vector = np.asarray(self.matrix[position], dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            if norm:
+                vector = vector / norm
+            if keep and (kept[:len(keep)] @ vector).max() >= self.duplicate_similarity:
+                skipped = True
+                continue
+            if kept is None:
+                kept = np.empty((len(top), len(vector)), dtype=np.float32)
+            kept[len(keep)] = vector
+            keep.append(i)
+            total += cost
+            if max_len - total < self.min_cost:
+                return top[keep], False
+        return top[keep], skipped
+
+    def _rank(self, q_embedding, question, mode, k):
+        # The k best candidates of one question in the given mode
+        if mode == LEXICAL:
+            return self.search_lexical(question, k)[0]
+        if mode == HYBRID:
+            return reciprocal_rank_fusion([self.search(q_embedding, k)[0], self.search_lexical(question, k)[0]], k)
+        return self.search(q_embedding, k)[0]
+
+    def _fill_ranked(self, top, max_len, q_embedding, question, mode):
+        rows, short = self._fill(top, max_len)
+        if short and len(top) >= self._candidates(max_len):
+            # Near duplicates left room and there may be more chunks, rank again with more candidates
+            rows, _ = self._fill(self._rank(q_embedding, question, mode, len(top) * DUPLICATE_OVERSAMPLE), max_len)
+        return rows
+
+    def select(self, q_embedding, max_len, question=None, mode=None):
+        """
+        Row positions of the most similar distinct chunks that fit in max_len tokens, best first.
+        The question is needed for the hybrid and lexical modes, the embedding for the other two.
+        """
+        mode = self.mode_for(mode, question)
+        top = self._rank(q_embedding, question, mode, self._candidates(max_len))
+        return self._fill_ranked(top, max_len, q_embedding, question, mode)
+
+    def select_many(self, q_embeddings, max_len, questions=None, mode=None):
+        """
+        select() for a matrix of questions, one row each
+        """
+        mode = self.mode_for(mode, questions)
+        k = self._candidates(max_len)
+        if mode == LEXICAL:
+            rankings = [self.search_lexical(question, k)[0] for question in questions]
+        else:
+            rankings = [top for top, _ in self.search_many(q_embeddings, k)]
+            if mode == HYBRID:
+                rankings = [reciprocal_rank_fusion([top, self.search_lexical(question, k)[0]], k)
+                            for top, question in zip(rankings, questions)]
+        if q_embeddings is None:
+            q_embeddings = [None] * len(rankings)
+        if questions is None:
+            questions = [None] * len(rankings)
+        return [self._fill_ranked(top, max_len, q, question, mode)
+                for top, q, question in zip(rankings, q_embeddings, questions)]
+
+    def context(self, q_embedding, max_len=1800, question=None, mode=None):
+        return CONTEXT_SEPARATOR.join(self.texts[i] for i in self.select(q_embedding, max_len, question, mode))
+
+    def contexts(self, q_embeddings, max_len=1800, questions=None, mode=None):
+        return [CONTEXT_SEPARATOR.join(self.texts[i] for i in rows)
+                for rows in self.select_many(q_embeddings, max_len, questions, mode)]
+
+
+class ShardedRows:
+    """
+    Read-only view of per-shard sequences (texts or embedding matrices) as one sequence, addressed by
+    global positions
+    """
+
+    def __init__(self, parts, offsets):
+        self.parts = parts
+        self.offsets = offsets
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, positions):
+        """
+        Shard numbers and positions within their shard of global positions
+        """
+        shards = np.searchsorted(self.offsets, positions, side='right') - 1
+        return shards, positions - self.offsets[shards]
+
+    def __getitem__(self, positions):
+        if np.ndim(positions) == 0:
+            shard, row = self.locate(positions)
+            return self.parts[shard][row]
+        shards, rows = self.locate(np.asarray(positions, dtype=np.int64))
+        return np.array([self.parts[shard][row] for shard, row in zip(shards, rows)])
+
+
+_shard_executor = None
+
+
+def shard_executor():
+    global _shard_executor
+    if _shard_executor is None:
+        _shard_executor = ThreadPoolExecutor(max_workers=SHARD_WORKERS, thread_name_prefix="shard")
+    return _shard_executor
+
+
+class ShardedRetriever(Retriever):
+    """
+    Searches several Retrievers (the shards of one or more topics) as one. A query is searched in every
+    shard in a thread pool and the per-shard top-k are merged by similarity before the context is
+    filled, so selecting and de-duplicating work exactly as for a single store. Positions are global:
+    the rows of the first shard, then those of the second one and so on.
+    """
+
+    def __init__(self, shards, names=None, duplicate_similarity=DUPLICATE_SIMILARITY):
+        self.shards = list(shards)
+        self.names = list(names) if names is not None else [shard.version for shard in self.shards]
+        self.offsets = np.concatenate([[0], np.cumsum([len(shard) for shard in self.shards])]).astype(np.int64)
+        self.version = "+".join(str(shard.version) for shard in self.shards)
+        self.duplicate_similarity = duplicate_similarity
+        self.texts = ShardedRows([shard.texts for shard in self.shards], self.offsets)
+        self.matrix = ShardedRows([shard.matrix for shard in self.shards], self.offsets)
+        self.n_tokens = np.concatenate([shard.n_tokens for shard in self.shards] + [np.empty(0, dtype=np.int64)])
+        self.costs = self.n_tokens + SEPARATOR_TOKENS
+        self.min_cost = int(self.costs.min()) if len(self.costs) else SEPARATOR_TOKENS
+
+    @property
+    def frame(self):
+        """
+        The chunk metadata of all shards with a shard column, assembled on every access
+        """
+        import pandas as pd
+
+        return pd.concat([shard.frame.assign(shard=name) for shard, name in zip(self.shards, self.names)
+                          if shard.frame is not None], ignore_index=True)
+
+    def _map(self, search):
+        if len(self.shards) == 1:
+            return [search(self.shards[0])]
+        return list(shard_executor().map(search, self.shards))
+
+    def _merge(self, results, k):
+        positions = np.concatenate([rows + offset for (rows, _), offset in zip(results, self.offsets)] +
+                                   [np.empty(0, dtype=np.int64)])
+        scores = np.concatenate([scores for _, scores in results] + [np.empty(0, dtype=np.float32)])
+        top = top_k(scores, k)
+        return positions[top], scores[top]
+
+    def search(self, q_embedding, k, nprobe=None):
+        return self._merge(self._map(lambda shard: shard.search(q_embedding, k, nprobe)), k)
+
+    def search_many(self, q_embeddings, k, nprobe=None):
+        per_shard = self._map(lambda shard: shard.search_many(q_embeddings, k, nprobe))
+        return [self._merge(results, k) for results in zip(*per_shard)]
+
+    @property
+    def has_lexical(self):
+        return any(shard.has_lexical for shard in self.shards)
+
+    def search_lexical(self, question, k):
+        # BM25 scores of different shards use their own statistics, close enough to merge for ranking
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+        return self._merge(self._map(lambda shard: shard.search_lexical(question, k) if shard.has_lexical
+                                     else empty), k)
+
+
+def as_retriever(data):
+    """
+    Accept either a Retriever or a DataFrame with an embeddings column
+    """
+    if isinstance(data, Retriever):
+        return data
+    return Retriever.from_frame(data)
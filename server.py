@@ -0,0 +1,296 @@
+# Purpose: Long-lived local query server. Topics are loaded once and kept in memory, questions are
+# served over HTTP on a TCP port or a Unix socket, and a topic is reloaded in the background and
+# swapped in atomically when its store is rewritten by a new ingest. POST /answer with "stream": true
+# sends the answer as it is generated, one JSON line per piece.
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from i import GPT_3_5_TURBO, answer_question, create_context, load_data, stream_answer
+from store import topic_files
+from streaming import astream
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+# Blocking work (embedding, chat completions, loading) runs in this many threads
+MAX_WORKERS = 16
+
+# Seconds between checks for rewritten stores
+WATCH_INTERVAL = 2.0
+
+# Largest request body accepted
+MAX_BODY = 1024 * 1024
+
+# Context and answer tokens of /answer requests that leave them out, sized for the default
+# gpt-3.5-turbo model like qa.py
+ANSWER_MAX_LEN = 1800
+ANSWER_MAX_TOKENS = 150
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def store_version(topic):
+    """
+    Modification times of the files of a topic (or of comma separated topics served as one), or None
+    if one is missing
+    """
+    try:
+        return tuple(os.stat(path).st_mtime_ns for name in topic.split(",") for path in topic_files(name))
+    except FileNotFoundError:
+        return None
+
+
+class Topics:
+    """
+    The loaded topics. A reload builds a new Retriever next to the old one and replaces it with a
+    single assignment, so requests already running keep using the one they started with.
+    """
+
+    def __init__(self, names, executor):
+        self.names = list(names)
+        self.executor = executor
+        self.retrievers = {}
+        self.versions = {}
+
+    async def load(self, topic):
+        loop = asyncio.get_running_loop()
+        version = store_version(topic)
+        started = time.perf_counter()
+        retriever = await loop.run_in_executor(self.executor, load_data, topic)
+        self.retrievers[topic] = retriever
+        self.versions[topic] = version
+        print(f"Loaded {topic} ({len(retriever)} chunks) in {time.perf_counter() - started:.1f}s")
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            for topic in self.names:
+                version = store_version(topic)
+                if version is None or version == self.versions.get(topic):
+                    continue
+                try:
+                    await self.load(topic)
+                except (OSError, ValueError) as e:
+                    # The two store files are swapped one after the other, try again on the next check
+                    print(f"Reloading {topic} failed, keeping the loaded version: {e}")
+
+    def get(self, topic):
+        retriever = self.retrievers.get(topic)
+        if retriever is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown topic {topic}")
+        return retriever
+
+
+async def read_request(reader):
+    """
+    Read one HTTP/1.1 request. Returns (method, path, headers, body) or None at the end of the connection.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode("UTF-8")
+    head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+
+
+async def write_stream(writer, pieces, trailer, keep_alive=True):
+    """
+    Send an answer as a chunked response of {"delta": piece} JSON lines ended by the trailer line.
+    A client that disconnects makes drain() raise, which closes pieces and cancels the completion.
+    """
+    head = (f"HTTP/1.1 200 OK\r\n"
+            f"Content-Type: application/x-ndjson\r\n"
+            f"Transfer-Encoding: chunked\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode("latin-1"))
+
+    def chunk(payload):
+        line = (json.dumps(payload) + "\n").encode("UTF-8")
+        writer.write(f"{len(line):x}\r\n".encode("latin-1") + line + b"\r\n")
+
+    try:
+        async for piece in pieces:
+            chunk({'delta': piece})
+            await writer.drain()
+    except ConnectionError:
+        raise
+    except Exception as e:
+        # The status is sent already, the error goes in the last line
+        print(e)
+        trailer = dict(trailer, error=str(e))
+    finally:
+        await pieces.aclose()
+    chunk(dict(trailer, done=True))
+    writer.write(b"0\r\n\r\n")
+
+
+def number(request, key, default, kind):
+    """
+    A numeric option of a request body, a missing one takes the default
+    """
+    try:
+        return kind(request.get(key, default))
+    except (TypeError, ValueError):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Expected a number for {key}")
+
+
+class Streamed:
+    """
+    A route result sent with write_stream() instead of as one JSON body
+    """
+
+    def __init__(self, pieces, trailer):
+        self.pieces = pieces
+        self.trailer = trailer
+
+
+class Server:
+    def __init__(self, topics, executor):
+        self.topics = topics
+        self.executor = executor
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return {'status': 'ok'}
+
+        if method == "GET" and path == "/topics":
+            return {'topics': [{'topic': topic, 'chunks': len(retriever), 'version': retriever.version}
+                               for topic, retriever in self.topics.retrievers.items()]}
+
+        if method != "POST" or path not in ("/retrieve", "/answer"):
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"No route for {method} {path}")
+
+        try:
+            request = json.loads(body or b"{}")
+            topic, question = request['topic'], request['question']
+            if not isinstance(topic, str) or not isinstance(question, str):
+                raise TypeError(question)
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Expected a JSON body with topic and question")
+
+        retriever = self.topics.get(topic)
+        if path == "/retrieve":
+            max_len = number(request, 'max_len', ANSWER_MAX_LEN, int)
+            context = await self.run(create_context, question, retriever, max_len=max_len, mode=request.get('mode'))
+            return {'topic': topic, 'version': retriever.version, 'context': context}
+
+        options = dict(model=request.get('model', GPT_3_5_TURBO), question=question,
+                       max_len_in=number(request, 'max_len', ANSWER_MAX_LEN, int),
+                       max_tokens_in=number(request, 'max_tokens', ANSWER_MAX_TOKENS, int),
+                       temperature=number(request, 'temperature', 0, float), mode=request.get('mode'))
+        if request.get('stream'):
+            # The context is built in a worker thread, the pieces are read from the stream in another one
+            pieces = await self.run(stream_answer, retriever, **options)
+            return Streamed(astream(pieces, self.executor), {'topic': topic, 'version': retriever.version})
+
+        answer = await self.run(answer_question, retriever, **options)
+        return {'topic': topic, 'version': retriever.version, 'answer': answer}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    result = await self.route(method, path.split("?", 1)[0], body)
+                    if isinstance(result, Streamed):
+                        await write_stream(writer, result.pieces, result.trailer, keep_alive)
+                    else:
+                        write_response(writer, HTTPStatus.OK, result, keep_alive)
+                except HTTPError as e:
+                    keep_alive = False
+                    write_response(writer, e.status, {'error': str(e)}, keep_alive)
+                except ValueError as e:
+                    keep_alive = False
+                    write_response(writer, HTTPStatus.BAD_REQUEST, {'error': str(e)}, keep_alive)
+                except ConnectionError:
+                    raise
+                except Exception as e:
+                    print(e)
+                    keep_alive = False
+                    write_response(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)}, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(topic_names, host=HOST, port=PORT, unix=None):
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    topics = Topics(topic_names, executor)
+    await asyncio.gather(*(topics.load(topic) for topic in topic_names))
+
+    server = Server(topics, executor)
+    if unix:
+        # A socket file left by a server that did not shut down cleanly would make the bind fail
+        if os.path.exists(unix):
+            os.remove(unix)
+        listener = await asyncio.start_unix_server(server.handle, path=unix)
+        print(f"Serving {', '.join(topic_names)} on {unix}")
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+        print(f"Serving {', '.join(topic_names)} on http://{host}:{port}")
+
+    watcher = asyncio.create_task(topics.watch())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        watcher.cancel()
+        executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve retrieve and answer requests for topics kept in memory")
+    parser.add_argument("topics", nargs="+")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead of a TCP port")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.topics, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,146 @@
+# Purpose: Parallel, change-aware walk of a source folder. A manifest of path, mtime, size and hash
+# from the last ingest lets unchanged files be skipped without reading them.
+import fnmatch
+import hashlib
+import json
+import os
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_INCLUDE = ["*.go"]
+
+# Patterns ending with "/" prune whole directories, the others are matched against file names and
+# paths relative to the folder
+DEFAULT_EXCLUDE = ["bindata.go", "*pb.go", ".git/", "vendor/", "node_modules/"]
+
+TEST_FILES = "*_test.go"
+
+# Skip source files that are too long, crawled pages are read whatever their length
+MAX_FILE_SIZE = 120000
+
+MAX_WORKERS = 16
+
+
+def manifest_path(topic):
+    return f"processed/{topic}_sources.json"
+
+
+def load_manifest(topic):
+    """
+    Return the manifest of the last ingest of a topic: {folder: {relative path: [mtime_ns, size, sha256]}}
+    """
+    try:
+        with open(manifest_path(topic), "r", encoding="UTF-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(topic, manifest):
+    path = manifest_path(topic)
+    with open(path + ".tmp", "w", encoding="UTF-8") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def matches(rel_path, patterns):
+    name = os.path.basename(rel_path)
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern) for pattern in patterns)
+
+
+def list_files(folder, include, exclude, use_git=False):
+    """
+    Relative paths of the files under folder that match include and not exclude. With use_git the
+    files come from `git ls-files`, which also skips everything ignored by .gitignore.
+    """
+    dir_patterns = [pattern.rstrip("/") for pattern in exclude if pattern.endswith("/")]
+    file_patterns = [pattern for pattern in exclude if not pattern.endswith("/")]
+
+    if use_git:
+        output = subprocess.run(["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"],
+                                cwd=folder, capture_output=True, check=True).stdout
+        candidates = [path for path in output.decode("UTF-8").split("\0") if path]
+        candidates = [path for path in candidates
+                      if not any(matches(part, dir_patterns) for part in path.split("/")[:-1])]
+    else:
+        candidates = []
+        for root, dirs, files in os.walk(folder):
+            # Prune excluded directories so vendored trees are never walked
+            dirs[:] = [d for d in dirs if not matches(d, dir_patterns)]
+            rel_root = os.path.relpath(root, folder)
+            for file in files:
+                candidates.append(file if rel_root == "." else os.path.join(rel_root, file))
+
+    return sorted(path for path in candidates if matches(path, include) and not matches(path, file_patterns))
+
+
+def read_file(folder, rel_path):
+    """
+    Return the content of a file and its hash, or (None, None) if it is not UTF-8 text
+    """
+    try:
+        with open(os.path.join(folder, rel_path), "r", encoding="UTF-8") as source_file:
+            content = source_file.read()
+    except UnicodeDecodeError:
+        return None, None
+    return content, hashlib.sha256(content.encode("UTF-8")).hexdigest()
+
+
+def scan(folder, previous=None, include=None, exclude=None, ignore_test_files=True, use_git=False):
+    """
+    Compare the files under folder with the manifest entries of the previous ingest without reading them.
+    Returns (to_read, unchanged, deleted): the (relative path, stat) of new or touched files, the manifest
+    entries of the untouched ones and the relative paths that no longer exist or are now excluded.
+    """
+    previous = previous or {}
+    include = include or DEFAULT_INCLUDE
+    exclude = list(DEFAULT_EXCLUDE if exclude is None else exclude)
+    if ignore_test_files:
+        exclude.append(TEST_FILES)
+
+    unchanged = {}
+    to_read = []
+    for rel_path in list_files(folder, include, exclude, use_git):
+        try:
+            stat = os.stat(os.path.join(folder, rel_path))
+        except FileNotFoundError:
+            continue
+
+        old = previous.get(rel_path)
+        if old is not None and old[0] == stat.st_mtime_ns and old[1] == stat.st_size:
+            unchanged[rel_path] = old
+        else:
+            to_read.append((rel_path, stat))
+
+    deleted = sorted(set(previous) - set(unchanged) - {rel_path for rel_path, _ in to_read})
+
+    return to_read, unchanged, deleted
+
+
+def read_files(folder, to_read, entries, max_workers=MAX_WORKERS, max_size=None):
+    """
+    Read the files of a scan in parallel and yield their (relative path, content) in order, adding
+    their manifest entries to entries. Only a few reads run ahead of the consumer, so memory stays
+    bounded. Files that are not text or longer than max_size are skipped, but still get an entry so
+    the next ingest does not read them again until they change.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        window = deque()
+        for rel_path, stat in to_read:
+            window.append((rel_path, stat, executor.submit(read_file, folder, rel_path)))
+            if len(window) >= 2 * max_workers:
+                yield from _read_result(window.popleft(), entries, max_size)
+
+        while window:
+            yield from _read_result(window.popleft(), entries, max_size)
+
+
+def _read_result(item, entries, max_size):
+    rel_path, stat, future = item
+    content, content_hash = future.result()
+    entries[rel_path] = [stat.st_mtime_ns, stat.st_size, content_hash]
+    if content is None or (max_size is not None and len(content) > max_size):
+        return
+    yield rel_path, content
+
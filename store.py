@@ -0,0 +1,308 @@
+# Purpose: Binary embedding store for a topic. The embeddings are kept as one contiguous float32
+# matrix in processed/<topic>_embeddings.npy and the chunk text and n_tokens in
+# processed/<topic>_chunks.parquet, so loading is a memory map instead of parsing list literals.
+# A sharded topic keeps each of its sources in a store of its own, listed in processed/<topic>_shards.json.
+# numpy, pandas and pyarrow are imported by the functions that read or write a store, so the naming
+# helpers can be used by `qa.py --list` without loading them.
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from urllib.parse import urlparse
+
+STORE_DIR = "processed/"
+
+# Bytes copied at a time when assembling the final matrix
+COPY_BUFFER = 16 * 1024 * 1024
+
+
+def store_paths(topic):
+    """
+    Return the (embeddings matrix, chunk metadata) paths of a topic
+    """
+    return f"{STORE_DIR}{topic}_embeddings.npy", f"{STORE_DIR}{topic}_chunks.parquet"
+
+
+def csv_path(topic):
+    return f"{STORE_DIR}{topic}_embeddings.csv"
+
+
+# The store of a source of a sharded topic is named <topic>--<source slug>
+SHARD_SEPARATOR = "--"
+
+
+def shard_name(topic, source):
+    """
+    Store name of a source of a topic: the host name of a website, the base name of a local folder
+    followed by a hash of its absolute path
+    """
+    parsed = urlparse(source)
+    if parsed.scheme in ("http", "https") and parsed.hostname:
+        slug = parsed.hostname
+    else:
+        path = os.path.abspath(os.path.expanduser(source)).rstrip(os.sep)
+        slug = f"{os.path.basename(path) or 'root'}-{hashlib.sha1(path.encode('UTF-8')).hexdigest()[:8]}"
+    return topic + SHARD_SEPARATOR + re.sub(r"[^A-Za-z0-9._-]+", "_", slug)
+
+
+def shards_path(topic):
+    return f"{STORE_DIR}{topic}_shards.json"
+
+
+def load_shards(topic):
+    """
+    Return the {source: shard store name} of a sharded topic, or None if the topic is not sharded
+    """
+    try:
+        with open(shards_path(topic), "r", encoding="UTF-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_shards(topic, shards):
+    path = shards_path(topic)
+    with open(path + ".tmp", "w", encoding="UTF-8") as f:
+        json.dump(shards, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def topic_files(topic):
+    """
+    Files whose modification means a topic has to be reloaded: its shard list and the matrices of the
+    shards ingested so far, or the two files of an unsharded store
+    """
+    shards = load_shards(topic)
+    if shards is None:
+        return list(store_paths(topic))
+    matrices = [store_paths(shard)[0] for shard in shards.values()]
+    return [shards_path(topic)] + [path for path in matrices if os.path.exists(path)]
+
+
+def remove_store(topic):
+    """
+    Delete every file derived for a store: matrix, chunks, manifest, index and quantized copies
+    """
+    prefix = f"{STORE_DIR}{topic}_"
+    for path in glob.glob(glob.escape(prefix) + "*"):
+        # The file suffixes have no dash, a dash means the file belongs to a longer shard name
+        if "-" not in path[len(prefix):]:
+            os.remove(path)
+    shutil.rmtree(f"{STORE_DIR}{topic}.ingest/", ignore_errors=True)
+
+
+def save_store(topic, data_frame, embeddings):
+    """
+    Save the chunk metadata (every column but embeddings) and the embeddings as a float32 matrix.
+    Both files are written to a temporary name first and then renamed so readers never see half a store.
+    """
+    import numpy as np
+    import pandas as pd
+
+    matrix_path, meta_path = store_paths(topic)
+    matrix = np.asarray(embeddings if not isinstance(embeddings, pd.Series) else embeddings.tolist(),
+                        dtype=np.float32)
+    if len(matrix) != len(data_frame):
+        raise ValueError(f"Got {len(matrix)} embeddings for {len(data_frame)} chunks.")
+
+    meta = data_frame.drop(columns=['embeddings'], errors='ignore').reset_index(drop=True)
+
+    tmp_matrix_path = matrix_path[:-len(".npy")] + ".tmp.npy"
+    tmp_meta_path = meta_path + ".tmp"
+    np.save(tmp_matrix_path, matrix)
+    meta.to_parquet(tmp_meta_path, index=False)
+    os.replace(tmp_matrix_path, matrix_path)
+    os.replace(tmp_meta_path, meta_path)
+
+    return matrix_path, meta_path
+
+
+def load_store(topic, mmap=True):
+    """
+    Load the chunk metadata DataFrame and the embeddings matrix of a topic. With mmap the matrix is
+    memory mapped read-only, so no embedding is read from disk until it is used.
+    """
+    import numpy as np
+    import pandas as pd
+
+    matrix_path, meta_path = store_paths(topic)
+    matrix = np.load(matrix_path, mmap_mode='r' if mmap else None)
+    meta = pd.read_parquet(meta_path)
+    if len(matrix) != len(meta):
+        raise ValueError(f"{matrix_path} has {len(matrix)} rows but {meta_path} has {len(meta)}.")
+
+    return meta, matrix
+
+
+def store_columns(topic):
+    """
+    Column names of the chunk metadata of a topic, or None if the topic has no store
+    """
+    import pyarrow.parquet as pq
+
+    _, meta_path = store_paths(topic)
+    if not os.path.exists(meta_path):
+        return None
+    return pq.ParquetFile(meta_path).schema_arrow.names
+
+
+def iter_store_batches(topic, batch_size, columns=None):
+    """
+    Yield (metadata DataFrame, embeddings) batches of a topic store without loading it all in memory
+    """
+    import numpy as np
+    import pyarrow.parquet as pq
+
+    matrix_path, meta_path = store_paths(topic)
+    matrix = np.load(matrix_path, mmap_mode='r')
+    start = 0
+    for batch in pq.ParquetFile(meta_path).iter_batches(batch_size=batch_size, columns=columns):
+        meta = batch.to_pandas()
+        yield meta, matrix[start:start + len(meta)]
+        start += len(meta)
+
+
+class StoreWriter:
+    """
+    Appends batches of chunks and their embeddings to a topic store being built in
+    processed/<topic>.ingest/. Every append is checkpointed, so an interrupted ingest with the same
+    digest resumes after its last flushed batch. finish() assembles the final store and swaps it in.
+    """
+
+    def __init__(self, topic, digest):
+        self.topic = topic
+        self.digest = digest
+        self.work_dir = f"{STORE_DIR}{topic}.ingest/"
+        self.raw_path = self.work_dir + "embeddings.f32"
+        self.checkpoint_path = self.work_dir + "checkpoint.json"
+        self.rows = 0
+        self.parts = 0
+        self.units_done = 0
+        self.dim = None
+
+        checkpoint = None
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r", encoding="UTF-8") as f:
+                checkpoint = json.load(f)
+
+        if checkpoint is not None and checkpoint['digest'] == digest:
+            self.rows, self.parts = checkpoint['rows'], checkpoint['parts']
+            self.units_done, self.dim = checkpoint['units_done'], checkpoint['dim']
+            print(f"Resuming ingest of {topic} after {self.rows} chunks")
+
+            # Drop whatever was written after the last checkpoint
+            with open(self.raw_path, "ab") as f:
+                f.truncate(self.rows * (self.dim or 0) * 4)
+            for name in os.listdir(self.work_dir):
+                if name.startswith("part-") and int(name[5:10]) >= self.parts:
+                    os.remove(self.work_dir + name)
+        else:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            os.makedirs(self.work_dir)
+
+    def _part_path(self, part):
+        return f"{self.work_dir}part-{part:05d}.parquet"
+
+    def append(self, data_frame, embeddings, units_done):
+        """
+        Append chunk metadata and embeddings, recording that the first units_done input units are in
+        """
+        import numpy as np
+
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if len(data_frame):
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+            elif matrix.shape[1] != self.dim:
+                raise ValueError(f"Got embeddings of dimension {matrix.shape[1]} instead of {self.dim}.")
+
+            with open(self.raw_path, "ab") as f:
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            data_frame.reset_index(drop=True).to_parquet(self._part_path(self.parts), index=False)
+            self.rows += len(data_frame)
+            self.parts += 1
+
+        self.units_done = units_done
+        checkpoint = {'digest': self.digest, 'rows': self.rows, 'parts': self.parts,
+                      'units_done': self.units_done, 'dim': self.dim}
+        with open(self.checkpoint_path + ".tmp", "w", encoding="UTF-8") as f:
+            json.dump(checkpoint, f)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def finish(self):
+        """
+        Assemble the .npy matrix and the Parquet metadata from the flushed batches, swap them in for
+        the previous store and remove the work directory
+        """
+        import numpy as np
+        import pandas as pd
+        import pyarrow.parquet as pq
+
+        matrix_path, meta_path = store_paths(self.topic)
+        tmp_matrix_path = matrix_path[:-len(".npy")] + ".tmp.npy"
+        tmp_meta_path = meta_path + ".tmp"
+
+        # The matrix is the raw float32 rows behind an .npy header
+        with open(tmp_matrix_path, "wb") as out:
+            header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)), 'fortran_order': False,
+                      'shape': (self.rows, self.dim or 0)}
+            np.lib.format.write_array_header_1_0(out, header)
+            if os.path.exists(self.raw_path):
+                with open(self.raw_path, "rb") as raw:
+                    shutil.copyfileobj(raw, out, COPY_BUFFER)
+
+        writer = None
+        for part in range(self.parts):
+            table = pq.read_table(self._part_path(part))
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_meta_path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        if writer is None:
+            pd.DataFrame({'text': [], 'n_tokens': []}).to_parquet(tmp_meta_path, index=False)
+        else:
+            writer.close()
+
+        os.replace(tmp_matrix_path, matrix_path)
+        os.replace(tmp_meta_path, meta_path)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+        return matrix_path, meta_path
+
+
+def convert_csv(topic):
+    """
+    One-shot conversion of a processed/<topic>_embeddings.csv written by older csvdf.py runs
+    """
+    import numpy as np
+    import pandas as pd
+
+    full_path = csv_path(topic)
+    print("Converting ", full_path, "...")
+    df = pd.read_csv(full_path, index_col=0)
+
+    # The embeddings were written as Python list literals of floats, which are valid JSON
+    matrix = None
+    for i, embedding in enumerate(df.pop('embeddings')):
+        row = json.loads(embedding)
+        if matrix is None:
+            matrix = np.empty((len(df), len(row)), dtype=np.float32)
+        matrix[i] = row
+
+    if matrix is None:
+        matrix = np.empty((0, 0), dtype=np.float32)
+
+    return save_store(topic, df, matrix)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python store.py <topic> [<topic> ...]")
+        sys.exit(1)
+
+    for csv_topic in sys.argv[1:]:
+        print("Saved ", *convert_csv(csv_topic))
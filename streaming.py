@@ -0,0 +1,114 @@
+# Purpose: Streamed chat completions. The answer is yielded piece by piece as the API sends it, with
+# time-to-first-token and total latency recorded, and the stream can be cancelled between pieces
+# with an event or by closing the generator. astream() offers the same as an async iterator.
+import asyncio
+import threading
+import time
+
+import instrument
+
+# Pieces buffered between the thread reading a stream and the event loop consuming it
+ASYNC_BUFFER = 256
+
+# Tokens the chat format adds per message and to prime the reply, on top of the message contents
+TOKENS_PER_MESSAGE = 3
+REPLY_PRIMING_TOKENS = 3
+
+
+def count_tokens(text):
+    from chunker import get_tokenizer
+
+    return len(get_tokenizer().encode(text, disallowed_special=()))
+
+
+def prompt_tokens(messages):
+    """
+    Tokens of a chat prompt as the API bills them, streamed responses carry no usage to read them from
+    """
+    return sum(TOKENS_PER_MESSAGE + count_tokens(message['content']) for message in messages) + REPLY_PRIMING_TOKENS
+
+
+def stream_chat(messages, model, max_tokens, stop=None, temperature=0, cancel=None, metric="openai.chat"):
+    """
+    Yield the content of a streamed chat completion as it arrives. Stops early when the cancel event
+    is set, which is checked before each piece, or when the generator is closed. Either way the
+    connection is released.
+    """
+    import openai
+
+    started = time.perf_counter()
+    response = openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        n=1,
+        stop=stop,
+        temperature=temperature,
+        stream=True,
+    )
+
+    instrument.count(f"{metric}.prompt_tokens", prompt_tokens(messages))
+    pieces = []
+    cancelled = False
+    try:
+        for chunk in response:
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+            content = chunk.choices[0].get('delta', {}).get('content') if chunk.choices else None
+            if not content:
+                continue
+            if not pieces:
+                instrument.observe(f"{metric}.ttft_ms", (time.perf_counter() - started) * 1000)
+            pieces.append(content)
+            yield content
+    except GeneratorExit:
+        cancelled = True
+        raise
+    finally:
+        close = getattr(response, 'close', None)
+        if close is not None:
+            close()
+        instrument.observe(f"{metric}.latency_ms", (time.perf_counter() - started) * 1000)
+        instrument.count(f"{metric}.completion_tokens", count_tokens("".join(pieces)))
+        if cancelled:
+            instrument.count(f"{metric}.cancelled")
+
+
+async def astream(pieces, executor=None):
+    """
+    Consume a blocking generator of pieces (e.g. i.stream_answer) in a worker thread and yield them in
+    the event loop. Leaving the loop early, or cancelling the task, closes the generator.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(ASYNC_BUFFER)
+    stop = threading.Event()
+    done = object()
+
+    def pump():
+        try:
+            for piece in pieces:
+                if stop.is_set():
+                    break
+                asyncio.run_coroutine_threadsafe(queue.put(piece), loop).result()
+        except BaseException as e:
+            asyncio.run_coroutine_threadsafe(queue.put(e), loop).result()
+        finally:
+            pieces.close()
+        asyncio.run_coroutine_threadsafe(queue.put(done), loop).result()
+
+    reader = loop.run_in_executor(executor, pump)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # Unblock the reader if it waits for room in the queue
+        while not queue.empty():
+            queue.get_nowait()
+        await reader